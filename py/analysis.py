@@ -0,0 +1,208 @@
+import numpy as np
+from math import pi as PI
+
+from baselines import ALPHA_L, ALPHA_O, EPS, DELTA_T, D_CM_MIN, V_MAX
+
+## Linear stability of the uniform flow on the ring.
+# Around the uniform flow (all gaps equal to h, all speeds equal to the
+# equilibrium speed v) the acceleration of the n-th car is linearised as
+#   da_n = f_v dv_n + f_l dv_{n-1} + f_d (dx_{n-1} - dx_n),
+# where f_v, f_l and f_d are the derivatives w.r.t. the follower speed,
+# the leader speed and the gap. On the ring the leader index n-1 is a
+# cyclic shift, so the linear system is block-circulant and a Fourier
+# mode dx_n ~ exp(i*k*n) decouples into a 2x2 system whose eigenvalues
+# solve
+#   lambda^2 - (f_v + f_l z) lambda - f_d (z - 1) = 0,   z = exp(-i*k).
+# The values of z for the N wavenumbers are the eigenvalues of the shift
+# operator, i.e. the FFT of its stencil.
+# The growth rates are those of the continuous time dynamics. Two cases
+# are not linear:
+# - the congested equilibria of all the models lie on the border of two
+#   regimes, so a perturbation moves the cars back and forth between
+#   them. Both sides are linearised: the flow is stable (unstable) if
+#   both are, and undecided (NaN) otherwise, the outcome then depending
+#   on the amplitude and on the integration scheme;
+# - when the equilibrium speed is clipped at V_MAX (or at 0, for gaps
+#   h <= 1), the speeds cannot grow (decrease) and the unstable modes
+#   saturate: the flow is neutrally stable.
+# simulated_growth_rate measures the same rate on a short run.
+
+def equilibrium_speed(model: str, h):
+    """Speed of the uniform flow with gap h (adimensional units).
+
+    This is the stationary speed reached by the cars in the congested
+    regimes of the models, clipped to [0, V_MAX] as done by Car.check_speed.
+    """
+    return np.clip(unclipped_speed(model, h), 0, V_MAX)
+
+def unclipped_speed(model: str, h):
+    h = np.asarray(h, dtype=float)
+    if model in ('ftl', 'opt_speed'):
+        return h - 1
+    elif model == 'm_ftl':
+        return (h - 1)/DELTA_T
+    raise ValueError('No linear stability analysis for model {}'.format(model))
+
+def speed_clipped(model: str, h):
+    """Whether the uniform flow with gap h runs at V_MAX or stands still."""
+    v = unclipped_speed(model, h)
+    return (v >= V_MAX) | (v <= 0)
+
+def linearise(model: str, h, alpha_l=ALPHA_L, alpha_o=ALPHA_O, eps=EPS, atol=1e-9,
+              above: bool = False):
+    """Derivatives (f_v, f_l, f_d) of the acceleration at the uniform flow.
+
+    The regimes are selected as in acc_ftl, acc_m_ftl and acc_opt_speed;
+    an equilibrium lying on the border of two regimes (within atol) is
+    assigned to the regime the kernel itself would pick, i.e. the one
+    below the border, or to the one above if `above`. Every argument
+    can be an array, the results are broadcast together.
+    """
+    h, alpha_l, alpha_o, eps = np.broadcast_arrays(*map(np.asarray, (h, alpha_l, alpha_o, eps)))
+    v = equilibrium_speed(model, h)
+    zero = np.zeros(h.shape)
+    tol = -atol if above else atol
+    if model == 'ftl':
+        d_s = np.where(v > 0, v + 1, 1)
+        free = h - d_s > tol
+        f_v = -alpha_l + zero
+        f_l = np.where(free, alpha_l, 0)
+        f_d = np.where(free, 0, alpha_l)
+    elif model == 'm_ftl':
+        d_s = np.where(v > 0, v*DELTA_T + 1, 1)
+        very_free = h - 20*d_s > tol
+        free = ~very_free & (h - d_s > tol)
+        f_v = np.where(very_free, -alpha_o, np.where(free, -alpha_l, -alpha_l*DELTA_T))
+        f_l = np.where(free, alpha_l*(1 + eps), 0)
+        f_d = np.where(very_free | free, 0, alpha_l)
+    elif model == 'opt_speed':
+        # the safety distance depends on the leader speed
+        d_s = 1 + v
+        very_free = h - 20*d_s > tol
+        free = ~very_free & (h - d_s > tol)
+        f_v = np.where(very_free, -alpha_o, np.where(free, -alpha_o, -5*alpha_o))
+        f_l = np.where(free, alpha_o, 0)
+        f_d = np.where(very_free | free, 0, 5*alpha_o)
+    else:
+        raise ValueError('No linear stability analysis for model {}'.format(model))
+    return f_v, f_l, f_d
+
+def linearise_fd(acc_fn, h, v, step=1e-6):
+    """Derivatives (f_v, f_l, f_d) of a vectorized acceleration kernel.
+
+    acc_fn(v_f, v_l, d) must accept arrays; derivatives are computed with
+    central differences, so they are meaningful only away from the
+    borders between regimes.
+    """
+    h, v = np.broadcast_arrays(np.asarray(h, dtype=float), np.asarray(v, dtype=float))
+    f_v = (acc_fn(v + step, v, h) - acc_fn(v - step, v, h))/(2*step)
+    f_l = (acc_fn(v, v + step, h) - acc_fn(v, v - step, h))/(2*step)
+    f_d = (acc_fn(v, v, h + step) - acc_fn(v, v, h - step))/(2*step)
+    return f_v, f_l, f_d
+
+def leader_symbol(n: int):
+    """Eigenvalues of the cyclic shift n -> n-1 for a ring of n cars."""
+    stencil = np.zeros(n)
+    stencil[1 % n] = 1
+    return np.fft.fft(stencil)
+
+def growth_rates(f_v, f_l, f_d, n: int):
+    """Growth rate (largest real part of the eigenvalues) per wavenumber.
+
+    The derivatives can be arrays of the same shape, the wavenumbers
+    k = 2*pi*m/n, m = 0, ..., n-1, are stacked along the last axis.
+    """
+    z = leader_symbol(n)
+    f_v, f_l, f_d = (np.asarray(f, dtype=float)[..., None] for f in (f_v, f_l, f_d))
+    b = f_v + f_l*z
+    sq = np.sqrt(b*b + 4*f_d*(z - 1) + 0j)
+    return np.maximum(((b + sq)/2).real, ((b - sq)/2).real)
+
+def ring_spacing(n_cars, radius):
+    """Uniform gap (adimensional units) of n_cars on a ring of radius in km."""
+    return 2*PI*np.asarray(radius)*1000/D_CM_MIN/np.asarray(n_cars)
+
+def max_growth_rate(model: str, n_cars: int, radius,
+                    alpha_l=ALPHA_L, alpha_o=ALPHA_O, eps=EPS, tol=1e-12):
+    """Largest growth rate over the non-trivial wavenumbers (m > 0).
+
+    The mode m = 0 is the translation of the whole ring and is excluded.
+    A value above tol means the uniform flow is linearly unstable, NaN
+    that the regimes on the two sides of the border disagree, 0 that
+    the flow is neutral.
+    """
+    h = ring_spacing(n_cars, radius)
+    sides = []
+    for above in (False, True):
+        f_v, f_l, f_d = linearise(model, h, alpha_l, alpha_o, eps, above=above)
+        rates = growth_rates(f_v, f_l, f_d, int(n_cars))
+        if n_cars < 2:
+            return np.zeros(rates.shape[:-1])
+        sides.append(rates[..., 1:].max(axis=-1))
+    below, above = sides
+    # away from the borders the two sides are the same regime
+    unstable = below > tol
+    rate = np.where(unstable == (above > tol),
+                    np.where(unstable, np.minimum(below, above), np.maximum(below, above)),
+                    np.nan)
+    return np.where(speed_clipped(model, h) & ~np.isnan(rate), np.minimum(rate, 0), rate)
+
+def simulated_growth_rate(model: str, n_cars: int, radius: float, scheme: str = 'euler',
+                          steps: int = 400, amplitude: float = 1e-3, seed: int = 0,
+                          **params):
+    """Growth rate of a small random perturbation of the uniform flow,
+    measured on a short run of models.evolve_euler_array or evolve_rk2_array.
+
+    The rate is the slope of the log of the standard deviation of the
+    gaps over the second half of the run, to compare with max_growth_rate.
+    """
+    from models import evolve_euler_array, evolve_rk2_array
+    from util import ring_distance
+    evolve = evolve_rk2_array if scheme == 'rk2' else evolve_euler_array
+    rng = np.random.default_rng(seed)
+    h = float(ring_spacing(n_cars, radius))
+    ring = h*n_cars
+    x = np.arange(n_cars)[::-1]*h + amplitude*rng.uniform(-1, 1, n_cars)
+    v = np.full(n_cars, float(equilibrium_speed(model, h)))
+    spread = []
+    for _ in range(steps):
+        x, v = evolve(x, v, ring, model, **params)
+        spread.append(np.std(ring_distance(x, np.roll(x, 1), ring)))
+    half = steps//2
+    return np.log(spread[-1]/spread[half-1])/((steps - half)*DELTA_T)
+
+def stability_map(model: str, n_cars, radius,
+                  alpha_l=ALPHA_L, alpha_o=ALPHA_O, eps=EPS):
+    """Largest growth rate over a grid of parameters.
+
+    Every argument can be a scalar or a 1-D sequence; the result has one
+    axis per argument, in the order (n_cars, radius, alpha_l, alpha_o, eps).
+    The spectrum is computed for all the points sharing the same number
+    of cars at once.
+    """
+    n_cars = np.atleast_1d(np.asarray(n_cars, dtype=int))
+    grids = np.meshgrid(*map(np.atleast_1d, (radius, alpha_l, alpha_o, eps)), indexing='ij')
+    out = np.zeros((len(n_cars),) + grids[0].shape)
+    for i, n in enumerate(n_cars):
+        out[i] = max_growth_rate(model, n, *grids)
+    return out
+
+def stability_boundary(values, rates, axis: int = -1, tol=1e-12):
+    """Values where the growth rate changes sign along an axis.
+
+    values are the grid values of the given axis of rates (e.g. the
+    output of stability_map); the crossing is linearly interpolated.
+    Returns NaN where no change of stability is found, or where the
+    first change borders an undecided (NaN) point.
+    """
+    values = np.asarray(values, dtype=float)
+    rates = np.moveaxis(np.asarray(rates), axis, -1)
+    unstable = rates > tol
+    change = unstable[..., 1:] != unstable[..., :-1]
+    idx = np.argmax(change, axis=-1)
+    r0 = np.take_along_axis(rates, idx[..., None], axis=-1)[..., 0]
+    r1 = np.take_along_axis(rates, idx[..., None] + 1, axis=-1)[..., 0]
+    x0, x1 = values[idx], values[idx + 1]
+    with np.errstate(divide='ignore', invalid='ignore'):
+        boundary = x0 - r0*(x1 - x0)/(r1 - r0)
+    return np.where(change.any(axis=-1), boundary, np.nan)
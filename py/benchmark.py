@@ -0,0 +1,62 @@
+import pathlib
+import subprocess
+import sys
+import time
+
+from baselines import V_MAX
+
+PY_DIR = pathlib.Path(__file__).parent.absolute()
+
+CORE_MODULES = ['baselines', 'car_class', 'util', 'models', 'perturbations',
+                'state', 'convergence', 'analysis']
+GUI_MODULES = ['my_widgets', 'visualizer']
+
+def time_import(module: str, repeat: int = 5):
+    """Best wall time (in s) needed to import a module in a fresh interpreter."""
+    code = 'import time; t = time.perf_counter(); import {}; ' \
+        'print(time.perf_counter() - t)'.format(module)
+    best = float('inf')
+    for _ in range(repeat):
+        out = subprocess.run([sys.executable, '-c', code], cwd=PY_DIR,
+                             capture_output=True, text=True)
+        if out.returncode != 0:
+            return None
+        best = min(best, float(out.stdout.strip()))
+    return best
+
+def bench_imports(repeat: int = 5):
+    for module in CORE_MODULES + GUI_MODULES:
+        t = time_import(module, repeat)
+        if t is None:
+            print('import {:<14s} unavailable'.format(module))
+        else:
+            print('import {:<14s} {:8.2f} ms'.format(module, t*1000))
+
+def bench_steps(model: str = 'ftl', scheme: str = 'rk2', n_cars: int = 50,
+                n_steps: int = 1000):
+    from state import Simulation
+    sim = Simulation(model=model, n_cars=n_cars, radius=2.0, filling=1.0,
+                     start_speed=V_MAX, scheme=scheme)
+    t = time.perf_counter()
+    sim.run(n_steps)
+    t = time.perf_counter() - t
+    print('{:>9s}/{:<5s} N={:<6d} {:8.2f} us/step'.format(model, scheme, n_cars,
+                                                         t/n_steps*1e6))
+
+def bench_stability_map(model: str = 'ftl'):
+    import numpy as np
+    from analysis import stability_map
+    n_cars = np.arange(10, 510, 10)
+    radius = np.linspace(0.1, 2.5, 50)
+    alpha_l = np.linspace(0.1, 4.0, 40)
+    t = time.perf_counter()
+    stability_map(model, n_cars, radius, alpha_l=alpha_l)
+    t = time.perf_counter() - t
+    print('stability map {} ({} points) {:8.2f} s'.format(model, len(n_cars)*len(radius)*len(alpha_l), t))
+
+
+if __name__ == '__main__':
+    bench_imports()
+    for model in ['ftl', 'm_ftl', 'opt_speed', 'ca']:
+        bench_steps(model=model)
+    bench_stability_map()
@@ -0,0 +1,155 @@
+import ast
+import functools
+import hashlib
+import json
+import os
+import pathlib
+import tempfile
+
+import numpy as np
+
+import baselines
+
+try:
+    import fcntl
+except ImportError: # not available on Windows, eviction is then unlocked
+    fcntl = None
+
+PY_DIR = pathlib.Path(__file__).parent.absolute()
+# Module whose run_config defines the results of a run
+ENTRY_POINT = 'simulation.py'
+
+def is_main_block(node):
+    return (isinstance(node, ast.If) and isinstance(node.test, ast.Compare)
+            and isinstance(node.test.left, ast.Name) and node.test.left.id == '__name__')
+
+@functools.lru_cache()
+def dependencies(name: str = ENTRY_POINT):
+    """Source files of the local modules imported, directly or not, by name.
+
+    Imports inside functions count too, so the list may be larger than
+    needed but never misses a module; the `if __name__ == '__main__'`
+    blocks (e.g. the GUI of simulation.py) are not followed.
+    """
+    seen, todo = set(), [name]
+    while todo:
+        name = todo.pop()
+        if name in seen or not (PY_DIR/name).exists():
+            continue
+        seen.add(name)
+        tree = ast.parse((PY_DIR/name).read_bytes())
+        tree.body = [node for node in tree.body if not is_main_block(node)]
+        for node in ast.walk(tree):
+            if isinstance(node, ast.Import):
+                todo += [alias.name.split('.')[0]+'.py' for alias in node.names]
+            elif isinstance(node, ast.ImportFrom) and node.module and node.level == 0:
+                todo.append(node.module.split('.')[0]+'.py')
+    return sorted(seen)
+
+def code_fingerprint():
+    h = hashlib.sha256()
+    for name in dependencies():
+        h.update(name.encode())
+        h.update((PY_DIR/name).read_bytes())
+    return h.hexdigest()
+
+def constants():
+    """Constants of baselines.py, they enter every run."""
+    return {name: value for name, value in vars(baselines).items()
+            if name.isupper() and isinstance(value, (int, float))}
+
+def config_key(config: dict):
+    """Stable hash of a run configuration, the constants and the code."""
+    payload = json.dumps({'config': config,
+                          'constants': constants(),
+                          'code': code_fingerprint()},
+                         sort_keys=True, default=str)
+    return hashlib.sha256(payload.encode()).hexdigest()
+
+class ResultCache(object):
+    """On-disk cache of run results, addressed by the hash of their configuration.
+
+    Each entry is a JSON file with the summary of the run and, optionally,
+    an .npz file with arrays (e.g. the final fields). Files are written to a
+    temporary name and renamed, so concurrent workers never see partial
+    entries; reading an entry refreshes its modification time, which is
+    used to evict the least recently used entries once the cache grows
+    beyond max_bytes.
+    """
+    def __init__(self, folder: pathlib.Path, max_bytes: int = 1 << 30):
+        self.folder = pathlib.Path(folder)
+        self.folder.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+
+    def paths(self, key: str):
+        base = self.folder/key[:2]/key
+        return base.with_suffix('.json'), base.with_suffix('.npz')
+
+    def get(self, config: dict, with_arrays: bool = False):
+        """Cached result of config (and its arrays), or None."""
+        summary_path, arrays_path = self.paths(config_key(config))
+        try:
+            with open(summary_path) as file:
+                entry = json.load(file)
+            os.utime(summary_path)
+            arrays = None
+            if with_arrays and entry['has_arrays']:
+                with np.load(arrays_path) as data:
+                    arrays = dict(data)
+                os.utime(arrays_path)
+        except (FileNotFoundError, json.JSONDecodeError, OSError, ValueError):
+            return None
+        if with_arrays:
+            return entry['result'], arrays
+        return entry['result']
+
+    def put(self, config: dict, result: dict, arrays: dict = None):
+        summary_path, arrays_path = self.paths(config_key(config))
+        summary_path.parent.mkdir(exist_ok=True)
+        if arrays is not None:
+            self._write(arrays_path, lambda file: np.savez(file, **arrays))
+        entry = {'config': config, 'result': result, 'has_arrays': arrays is not None}
+        self._write(summary_path, lambda file: file.write(json.dumps(entry, default=float).encode()))
+        self.evict()
+
+    def _write(self, path: pathlib.Path, write_fn):
+        fd, tmp = tempfile.mkstemp(dir=path.parent, prefix='.tmp-')
+        try:
+            with os.fdopen(fd, 'wb') as file:
+                write_fn(file)
+            os.replace(tmp, path)
+        except BaseException:
+            if os.path.exists(tmp):
+                os.unlink(tmp)
+            raise
+
+    def entries(self):
+        """(mtime, size, path) of the stored files, oldest first."""
+        out = []
+        for path in self.folder.glob('*/*'):
+            if path.name.startswith('.tmp-'):
+                continue
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                continue
+            out.append((stat.st_mtime, stat.st_size, path))
+        return sorted(out)
+
+    def size(self):
+        return sum(size for _, size, _ in self.entries())
+
+    def evict(self):
+        with open(self.folder/'.lock', 'w') as lock:
+            if fcntl is not None:
+                fcntl.flock(lock, fcntl.LOCK_EX)
+            entries = self.entries()
+            total = sum(size for _, size, _ in entries)
+            for _, size, path in entries:
+                if total <= self.max_bytes:
+                    break
+                try:
+                    path.unlink()
+                except FileNotFoundError:
+                    pass
+                total -= size
@@ -0,0 +1,246 @@
+from argparse import RawTextHelpFormatter, ArgumentParser
+from multiprocessing import Pool
+import pathlib
+
+import numpy as np
+from math import pi as PI
+from scipy.optimize import differential_evolution, minimize
+
+from util import ring_distance
+from models import evolve_rk2_array, evolve_euler_array
+from baselines import DELTA_T, D_CM_MIN, ALPHA_L, ALPHA_O, EPS
+
+# Parameters that can be calibrated, with their defaults and search bounds.
+# d_min and t_safe define the safety distance d_s = d_min + t_safe*v of
+# the vectorized kernels in models.py.
+PARAMETERS = {
+    'alpha_l': (ALPHA_L, (0.05, 4.0)),
+    'alpha_o': (ALPHA_O, (0.05, 4.0)),
+    'eps': (EPS, (0.0, 0.2)),
+    'd_min': (1.0, (0.2, 3.0)),
+    't_safe': (None, (0.0, 2.0)),
+}
+
+def load_reference(folder: pathlib.Path, radius: float):
+    """Load a reference trajectory in the format written by Simulation.dump.
+
+    The folder holds positions_<t>.npy, speed_field_<t>.npy and
+    distance_field_<t>.npy files; the first time is the initial state.
+    radius is given in km, as on the command line.
+    """
+    folder = pathlib.Path(folder)
+    times = sorted(float(f.stem[len('positions_'):]) for f in folder.glob('positions_*.npy'))
+    if len(times) < 2:
+        raise ValueError('At least two dumps are needed in {}'.format(folder))
+    load = lambda name, t: np.load(folder/'{}_{}.npy'.format(name, t))
+    return {
+        'x0': load('positions', times[0]),
+        'v0': load('speed_field', times[0]),
+        'speeds': np.stack([load('speed_field', t) for t in times[1:]]),
+        'gaps': np.stack([load('distance_field', t) for t in times[1:]]),
+        'sample_steps': np.rint((np.array(times[1:]) - times[0])/DELTA_T).astype(int),
+        'ring': 2*PI*radius*1000/D_CM_MIN,
+    }
+
+def simulate_batch(model: str, params: dict, x0, v0, ring: float, sample_steps,
+                   scheme: str = 'rk2', seed: int = None):
+    """Evolve one ring per parameter set, all at once.
+
+    params maps parameter names to arrays of length n_sets; every set
+    starts from (x0, v0). Returns the speeds and the gaps at sample_steps,
+    with shape (n_sets, n_samples, n_cars).
+    """
+    n_sets = len(next(iter(params.values())))
+    params = {name: np.asarray(value, dtype=float)[:, None] for name, value in params.items()}
+    evolve = evolve_rk2_array if scheme == 'rk2' else evolve_euler_array
+    rng = np.random.default_rng(seed) if model == 'opt_speed' else None
+    x = np.tile(np.asarray(x0, dtype=float), (n_sets, 1))
+    v = np.tile(np.asarray(v0, dtype=float), (n_sets, 1))
+    speeds = np.zeros((n_sets, len(sample_steps), x.shape[1]))
+    gaps = np.zeros_like(speeds)
+    step = 0
+    for k, target in enumerate(sample_steps):
+        for _ in range(target - step):
+            x, v = evolve(x, v, ring, model, rng, **params)
+        step = target
+        speeds[:, k] = v
+        gaps[:, k] = ring_distance(x, np.roll(x, 1, axis=-1), ring)
+    return speeds, gaps
+
+def nmse(sim, ref):
+    """Mean squared error normalised by the variance of the reference."""
+    return np.mean((sim - ref)**2, axis=(-2, -1))/(np.var(ref) + 1e-12)
+
+LOSSES = {
+    'speed': lambda speeds, gaps, ref: nmse(speeds, ref['speeds']),
+    'gap': lambda speeds, gaps, ref: nmse(gaps, ref['gaps']),
+    'speed_gap': lambda speeds, gaps, ref: nmse(speeds, ref['speeds']) + nmse(gaps, ref['gaps']),
+}
+
+def score_batch(candidates, names, model: str, reference: dict, loss='speed_gap',
+                scheme: str = 'rk2', seed: int = None):
+    """Loss of each candidate, given as a row of candidates.
+
+    loss is the name of one of LOSSES or a function
+    loss(speeds, gaps, reference) returning one value per candidate.
+    """
+    candidates = np.atleast_2d(candidates)
+    loss_fn = LOSSES[loss] if isinstance(loss, str) else loss
+    params = {name: candidates[:, i] for i, name in enumerate(names)}
+    speeds, gaps = simulate_batch(model, params, reference['x0'], reference['v0'],
+                                  reference['ring'], reference['sample_steps'],
+                                  scheme=scheme, seed=seed)
+    scores = loss_fn(speeds, gaps, reference)
+    return np.where(np.isfinite(scores), scores, np.inf)
+
+_worker_kwargs = None
+
+def _init_worker(kwargs):
+    global _worker_kwargs
+    _worker_kwargs = kwargs
+
+def _score_chunk(candidates):
+    return score_batch(candidates, **_worker_kwargs)
+
+class BatchObjective(object):
+    """Objective scoring a whole population per call.
+
+    The population is split in one chunk per worker of the pool, each
+    chunk being simulated as a single vectorized batch.
+    """
+    def __init__(self, pool: Pool = None, n_chunks: int = 1, **kwargs):
+        self.pool = pool
+        self.n_chunks = n_chunks
+        self.kwargs = kwargs
+
+    def __call__(self, population):
+        # scipy passes the population as (n_params, n_candidates)
+        candidates = np.atleast_2d(np.asarray(population).T)
+        if self.pool is None or len(candidates) < 2:
+            return score_batch(candidates, **self.kwargs)
+        chunks = np.array_split(candidates, min(self.n_chunks, len(candidates)))
+        return np.concatenate(self.pool.map(_score_chunk, chunks))
+
+def calibrate(model: str, reference: dict, names=('alpha_l',), bounds: dict = None,
+              loss='speed_gap', optimiser: str = 'de', workers: int = 1,
+              popsize: int = 15, maxiter: int = 100, scheme: str = 'rk2',
+              seed: int = None, verbose: int = 0):
+    """Fit the parameters names of a model to a reference trajectory.
+
+    optimiser is 'de' (differential evolution, each generation is scored
+    as one batch split over `workers` processes) or 'nelder-mead'
+    (one candidate at a time, starting from the defaults).
+    Returns the best parameters as a dictionary and the scipy result.
+    """
+    names = tuple(names)
+    bounds = dict(bounds or {})
+    bounds = [bounds.get(name, PARAMETERS[name][1]) for name in names]
+    kwargs = dict(names=names, model=model, reference=reference, loss=loss,
+                  scheme=scheme, seed=seed)
+    pool = Pool(workers, initializer=_init_worker, initargs=(kwargs,)) if workers > 1 else None
+    objective = BatchObjective(pool=pool, n_chunks=workers, **kwargs)
+    try:
+        if optimiser == 'de':
+            result = differential_evolution(objective, bounds, popsize=popsize,
+                                            maxiter=maxiter, seed=seed, polish=False,
+                                            vectorized=True, updating='deferred',
+                                            disp=verbose > 0)
+        elif optimiser == 'nelder-mead':
+            x0 = [PARAMETERS[name][0] if PARAMETERS[name][0] is not None else np.mean(b)
+                  for name, b in zip(names, bounds)]
+            result = minimize(lambda p: objective(np.asarray(p)[:, None])[0], x0,
+                              method='Nelder-Mead', bounds=bounds,
+                              options={'maxiter': maxiter, 'disp': verbose > 0})
+        else:
+            raise ValueError('Unknown optimiser {}'.format(optimiser))
+    finally:
+        if pool is not None:
+            pool.close()
+            pool.join()
+    return dict(zip(names, map(float, result.x))), result
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Fit the parameters of a model to a reference trajectory, '
+                            'given as a folder of dumps (see Simulation.dump).',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('reference',
+                        type=type(''),
+                        action='store',
+                        help='Folder containing the dumps of the reference trajectory')
+    parser.add_argument('-m', '--model',
+                        dest='model',
+                        required=False,
+                        type=type(''),
+                        default='ftl',
+                        choices=['ftl', 'opt_speed', 'm_ftl'],
+                        action='store',
+                        help='Set the model to calibrate')
+    parser.add_argument('-r', '--radius',
+                        dest='radius',
+                        required=False,
+                        type=float,
+                        default=2.0,
+                        action='store',
+                        help='Set the radius of the track (in km)')
+    parser.add_argument('-s', '--scheme',
+                        dest='scheme',
+                        required=False,
+                        type=type(''),
+                        default='rk2',
+                        choices=['rk2', 'euler'],
+                        action='store',
+                        help='Set the scheme for the evolution')
+    parser.add_argument('-p', '--params',
+                        dest='params',
+                        required=False,
+                        nargs='+',
+                        default=['alpha_l'],
+                        choices=list(PARAMETERS.keys()),
+                        help='Set the parameters to calibrate')
+    parser.add_argument('--loss',
+                        dest='loss',
+                        required=False,
+                        type=type(''),
+                        default='speed_gap',
+                        choices=list(LOSSES.keys()),
+                        action='store',
+                        help='Set the loss comparing simulated and reference series')
+    parser.add_argument('--optimiser',
+                        dest='optimiser',
+                        required=False,
+                        type=type(''),
+                        default='de',
+                        choices=['de', 'nelder-mead'],
+                        action='store',
+                        help='Set the derivative-free optimiser')
+    parser.add_argument('-w', '--workers',
+                        dest='workers',
+                        required=False,
+                        type=int,
+                        default=1,
+                        action='store',
+                        help='Set the number of processes scoring the population')
+    parser.add_argument('--maxiter',
+                        dest='maxiter',
+                        required=False,
+                        type=int,
+                        default=100,
+                        action='store',
+                        help='Set the maximum number of iterations of the optimiser')
+    parser.add_argument('--seed',
+                        dest='seed',
+                        required=False,
+                        type=int,
+                        default=51550,
+                        action='store',
+                        help='Set the seed of the random number generators')
+    args = parser.parse_args()
+    reference = load_reference(args.reference, args.radius)
+    best, result = calibrate(args.model, reference, names=args.params, loss=args.loss,
+                             optimiser=args.optimiser, workers=args.workers,
+                             maxiter=args.maxiter, scheme=args.scheme, seed=args.seed,
+                             verbose=1)
+    print('Best parameters (loss {:.6g}):'.format(result.fun))
+    for name, value in best.items():
+        print('\t{} = {:.6g}'.format(name, value))
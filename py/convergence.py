@@ -0,0 +1,165 @@
+from collections import deque
+
+import numpy as np
+
+def average(x, w):
+    # only the entries carrying cars count: the gaps of the empty cells
+    # of lwr are undefined
+    cars = w > 0
+    return np.average(x[cars], weights=w[cars])
+
+# Statistics that can be tracked by the monitor, computed from the
+# speed and distance fields and weighted by the number of cars behind
+# each entry (one per car, the cars of each cell for lwr)
+STATISTICS = {
+    'mean_speed': lambda v, d, w: average(v, w),
+    'speed_var': lambda v, d, w: average((v - average(v, w))**2, w),
+    'gap_mean': lambda v, d, w: average(d, w),
+    'gap_std': lambda v, d, w: np.sqrt(average((d - average(d, w))**2, w)),
+    'gap_min': lambda v, d, w: np.min(d[w > 0]),
+}
+
+# Statistics tracked by default
+DEFAULT_STATISTICS = ('mean_speed', 'speed_var', 'gap_std')
+
+TRANSIENT = 'transient'
+STEADY = 'steady'
+PERIODIC = 'periodic'
+
+class ConvergenceMonitor(object):
+    """Detect when a run has reached a steady state or a periodic regime.
+
+    Every `every` steps the monitor samples some statistics of the
+    speed and distance fields and keeps the last 2*`window` samples.
+    The run is declared:
+    - periodic (stop-and-go), if the mean speed oscillates (with a relative
+      amplitude above `rtol`, `atol` as an absolute floor) and its
+      autocorrelation, after first turning negative, has a peak above
+      `acf_threshold` at a lag of at least `min_period` samples, the peak
+      lag being the same within one sample in the two halves of the buffer;
+    - steady, if for every statistic the means over the two halves of the
+      buffer are equal: their difference is within `z` standard errors,
+      or below `atol` for the runs without fluctuations. The standard
+      errors come from the means of `n_batches` consecutive batches of
+      each half, which absorbs the autocorrelation of the samples.
+    The state is checked only once the buffer is full.
+    """
+    def __init__(self,
+                 window: int = 50,
+                 every: int = 10,
+                 rtol: float = 1e-2,
+                 atol: float = 1e-6,
+                 statistics: tuple = DEFAULT_STATISTICS,
+                 detect_periodic: bool = True,
+                 acf_threshold: float = 0.8,
+                 min_period: int = 3,
+                 z: float = 3.0,
+                 n_batches: int = 10):
+        self.window = window
+        self.every = every
+        self.rtol = rtol
+        self.atol = atol
+        self.statistics = tuple(statistics)
+        self.detect_periodic = detect_periodic
+        self.acf_threshold = acf_threshold
+        self.min_period = min_period
+        self.z = z
+        self.n_batches = n_batches
+        self.reset()
+
+    def reset(self):
+        self.n_steps = 0
+        self.samples = {name: deque(maxlen=2*self.window) for name in self.statistics}
+        if self.detect_periodic and 'mean_speed' not in self.samples:
+            self.samples['mean_speed'] = deque(maxlen=2*self.window)
+        self.state = TRANSIENT
+        self.period = None
+        self.converged_at = None
+
+    @property
+    def converged(self):
+        return self.state != TRANSIENT
+
+    def update(self, sim):
+        """Sample a Simulation (every `every` calls) and update the state.
+
+        Returns True once a steady or periodic regime has been detected.
+        """
+        self.n_steps += 1
+        if self.n_steps % self.every != 0:
+            return self.converged
+        v, d, w = sim.speeds(), sim.distances(), sim.weights()
+        for name, buffer in self.samples.items():
+            buffer.append(STATISTICS[name](v, d, w))
+        if not self.converged:
+            self.check()
+        return self.converged
+
+    def check(self):
+        if len(self.samples['mean_speed']) < 2*self.window:
+            return self.state
+        # an oscillation is stationary too: look for it first
+        if self.detect_periodic and self.is_periodic():
+            self.state = PERIODIC
+        elif self.is_steady():
+            self.state = STEADY
+        if self.converged:
+            self.converged_at = self.n_steps
+        return self.state
+
+    def is_steady(self):
+        for name in self.statistics:
+            x = np.array(self.samples[name])
+            old, new = x[:self.window], x[self.window:]
+            se = np.hypot(self.standard_error(old), self.standard_error(new))
+            if abs(new.mean() - old.mean()) > max(self.z*se, self.atol):
+                return False
+        return True
+
+    def standard_error(self, x):
+        """Standard error of the mean of x, from the spread of the means
+        of consecutive batches."""
+        n_batches = max(min(self.n_batches, len(x)//2), 2)
+        size = len(x)//n_batches
+        means = x[len(x) - n_batches*size:].reshape(n_batches, size).mean(axis=1)
+        return means.std(ddof=1)/np.sqrt(n_batches)
+
+    def is_periodic(self):
+        x = np.array(self.samples['mean_speed'])
+        if x.std() <= max(self.rtol*np.abs(x).max(), self.atol):
+            return False
+        lags = [self.dominant_lag(half) for half in (x[:self.window], x[self.window:])]
+        if None in lags or abs(lags[0] - lags[1]) > 1:
+            return False
+        self.period = lags[1]*self.every
+        return True
+
+    def dominant_lag(self, x):
+        x = x - x.mean()
+        if not np.any(x):
+            return None
+        n = len(x)
+        if n//2 <= self.min_period:
+            return None
+        # autocorrelation through FFT, zero padded to avoid the wrap around
+        f = np.fft.rfft(x, 2*n)
+        acf = np.fft.irfft(f*np.conj(f))[:n]
+        # unbiased estimate: the lag k sums only n-k products
+        acf = acf/acf[0]*n/(n - np.arange(n))
+        # a slow drift also correlates at short lags: only look for the
+        # peak after the autocorrelation has first become negative
+        negative = np.flatnonzero(acf[:n//2] < 0)
+        if len(negative) == 0:
+            return None
+        start = max(self.min_period, negative[0])
+        if start >= n//2:
+            return None
+        lag = start + np.argmax(acf[start:n//2])
+        if acf[lag] < self.acf_threshold:
+            return None
+        return int(lag)
+
+    def summary(self):
+        """Mean of the tracked statistics over the last window."""
+        return {name: float(np.mean(list(buffer)[-self.window:]))
+                for name, buffer in self.samples.items() if len(buffer) > 0}
@@ -0,0 +1,197 @@
+import math
+
+import numpy as np
+
+from analysis import equilibrium_speed
+from baselines import ACC, D_CM_MIN, DELTA_T, TAU, V_MAX
+
+## Lighthill-Whitham-Richards model
+# The cars are described by their density rho(x, t) (cars per unit
+# length) on the ring, which evolves as
+#   d rho/dt + d Q(rho)/dx = 0,
+# Q(rho) = rho*v(rho) being the fundamental diagram. The ring is divided
+# in cells and solved with the Godunov scheme in its cell transmission
+# form: the flux from a cell to the next one is the minimum between the
+# demand of the upstream cell and the supply of the downstream one.
+
+# Density below which a cell counts as empty
+EMPTY = 1e-12
+
+class FundamentalDiagram(object):
+    """Tabulated flux-density relation Q(rho), with rho in [0, rho_max]."""
+    def __init__(self, density, flux):
+        self.density = np.asarray(density, dtype=float)
+        self.flux = np.asarray(flux, dtype=float)
+        i_c = np.argmax(self.flux)
+        self.rho_c = self.density[i_c] # critical density
+        self.q_max = self.flux[i_c] # capacity
+        self.rho_max = self.density[-1] # jam density
+        slopes = np.diff(self.flux)/np.diff(self.density)
+        self.v_free = slopes[0]
+        self.max_wave_speed = np.abs(slopes).max()
+
+    @classmethod
+    def from_model(cls, model: str, n_points: int = 2001):
+        """Equilibrium flux of a microscopic model (see analysis.equilibrium_speed).
+
+        A uniform flow with gap h has density 1/h; the jam density is one
+        car every D_CM_MIN, i.e. 1 in adimensional units.
+        """
+        density = np.linspace(0, 1, n_points)
+        with np.errstate(divide='ignore'):
+            speed = equilibrium_speed(model, 1/density)
+        return cls(density, density*speed)
+
+    @classmethod
+    def triangular(cls, v_free: float, rho_max: float, w: float):
+        """Triangular diagram with free speed v_free and backward wave speed w."""
+        rho_c = w*rho_max/(v_free + w)
+        return cls([0, rho_c, rho_max], [0, v_free*rho_c, 0])
+
+    @classmethod
+    def fit(cls, density, flux, rho_max: float = 1.0):
+        """Triangular diagram fitted to (density, flux) samples, e.g. from runs
+        of the microscopic models.
+
+        The free branch is a line through the origin fitted on the samples
+        below the density of maximum flux, the congested one a line through
+        (rho_max, 0) fitted on the others.
+        """
+        density, flux = np.asarray(density, dtype=float), np.asarray(flux, dtype=float)
+        free = density <= density[np.argmax(flux)]
+        v_free = np.sum(density[free]*flux[free])/np.sum(density[free]**2)
+        dr = rho_max - density[~free]
+        w = np.sum(dr*flux[~free])/np.sum(dr**2) if np.any(~free) else v_free
+        return cls.triangular(v_free, rho_max, w)
+
+    def q(self, rho):
+        return np.interp(rho, self.density, self.flux)
+
+    def speed(self, rho):
+        with np.errstate(divide='ignore', invalid='ignore'):
+            return np.where(rho > EMPTY, self.q(rho)/rho, self.v_free)
+
+    def demand(self, rho):
+        return self.q(np.minimum(rho, self.rho_c))
+
+    def supply(self, rho):
+        return self.q(np.maximum(rho, self.rho_c))
+
+class LWR(object):
+    """Godunov solver of the LWR model on a periodic grid.
+
+    It is initialised like the microscopic models: n_cars spread
+    uniformly over the first `filling` fraction of a ring of length ring,
+    starting from x = 0, or over as much of it as they need at the jam
+    density. The interface between cell i and cell i+1 can
+    have its capacity reduced, which is how the traffic light and the
+    brakes are modelled.
+    """
+    def __init__(self,
+                 fd: FundamentalDiagram = None,
+                 ring: float = None,
+                 n_cars: int = None,
+                 filling: float = 1.0,
+                 n_cells: int = 1000,
+                 cfl: float = 0.9):
+        self.fd = fd
+        self.ring = ring
+        self.n_cells = n_cells
+        self.dx = ring/n_cells
+        if n_cars > ring*fd.rho_max:
+            raise ValueError('{} cars do not fit in a ring of length {} at the jam density {}'
+                             .format(n_cars, ring, fd.rho_max))
+        self.density = np.zeros(n_cells)
+        # a platoon denser than the jam density is stretched to fit
+        length = min(max(filling*ring, n_cars/fd.rho_max, 1e-12), ring)
+        self.platoon_length = length
+        coverage = np.clip((length - np.arange(n_cells)*self.dx)/self.dx, 0, 1)
+        self.density[:] = coverage*min(n_cars/length, fd.rho_max)
+        # the light is in front of the first car, at the end of the platoon
+        self.light_interface = int(math.ceil(length/self.dx)-1) % n_cells
+        self.light = 1.0
+        self.bottlenecks = dict() # interface -> [capacity factor, steps left]
+        self.n_sub = max(1, int(math.ceil(DELTA_T*fd.max_wave_speed/(cfl*self.dx))))
+
+    @property
+    def n_cars(self):
+        return self.density.sum()*self.dx
+
+    def positions(self):
+        return (np.arange(self.n_cells) + 0.5)*self.dx
+
+    def speeds(self):
+        """Equilibrium speed of each cell (the free speed for empty cells)."""
+        return self.fd.speed(self.density)
+
+    def distances(self):
+        """Mean gap 1/density of the cars of each cell, NaN for empty cells.
+
+        The numerical diffusion leaves tiny densities ahead of the jams,
+        whose gaps are capped at the ring.
+        """
+        gaps = np.divide(1, self.density, out=np.full(self.n_cells, np.nan),
+                         where=self.density > EMPTY)
+        return np.minimum(gaps, self.ring)
+
+    def weights(self):
+        """Number of cars in each cell (0 for the empty ones)."""
+        return np.where(self.density > EMPTY, self.density*self.dx, 0.0)
+
+    def capacity(self):
+        capacity = np.full(self.n_cells, self.fd.q_max)
+        capacity[self.light_interface] *= self.light
+        for interface, (factor, _) in self.bottlenecks.items():
+            capacity[interface] *= factor
+        return capacity
+
+    def set_traffic_light(self, red: bool):
+        # the capacity through the light drops like the max speed of the
+        # first car in the microscopic models
+        self.light = max(self.light - ACC/V_MAX, 0) if red else 1.0
+
+    def step(self, dt: float = DELTA_T):
+        capacity = self.capacity()
+        h = dt/self.n_sub
+        for _ in range(self.n_sub):
+            # flux[i] goes from cell i to cell i+1
+            flux = np.minimum(self.fd.demand(self.density),
+                              self.fd.supply(np.roll(self.density, -1)))
+            flux = np.minimum(flux, capacity)
+            self.density += h/self.dx*(np.roll(flux, 1) - flux)
+        for interface in list(self.bottlenecks):
+            self.bottlenecks[interface][1] -= 1
+            if self.bottlenecks[interface][1] <= 0:
+                del self.bottlenecks[interface]
+
+    def perturb(self, id: int, rng):
+        """Counterpart of the perturbations of perturbations.get_pert_fn.
+
+        1-3: density noise of increasing intensity, 4: random density,
+        5/6: a car braking by 10 m/s at the front/middle of the platoon,
+        i.e. a bottleneck lasting one second. The number of cars is kept.
+        """
+        n_cars = self.n_cars
+        if id in (1, 2, 3):
+            self.density *= 1 + 0.05*id*rng.uniform(-1, 1, self.n_cells)
+        elif id == 4:
+            self.density = rng.uniform(0, self.fd.rho_max, self.n_cells)
+        elif id in (5, 6):
+            interface = self.light_interface
+            if id == 6:
+                interface = (interface - int(self.platoon_length/2/self.dx)) % self.n_cells
+            drop = min(10/D_CM_MIN*TAU/V_MAX, 1)
+            self.bottlenecks[interface] = [1 - drop, int(round(1/DELTA_T))]
+            return
+        else:
+            raise KeyError(id)
+        self.density = np.clip(self.density, 0, self.fd.rho_max)
+        if self.density.sum() > 0:
+            self.density *= n_cars/self.n_cars
+        # the density above the jam one goes to the other cells, in
+        # proportion to the room left in them, so that none overflows
+        excess = np.maximum(self.density - self.fd.rho_max, 0).sum()
+        self.density = np.minimum(self.density, self.fd.rho_max)
+        room = self.fd.rho_max - self.density
+        if excess > 0 and room.sum() > 0:
+            self.density += excess*room/room.sum()
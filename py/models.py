@@ -1,7 +1,8 @@
 import math
 from math import pi as PI
+import numpy as np
 
-from util import ring_distance_1d
+from util import ring_distance_1d, ring_distance
 from baselines import (ACC, D_CM_MIN, ALPHA_L,
                        ALPHA_O, EPS, DELTA_T, V_MAX)
         
@@ -168,3 +169,75 @@ def acc_m_ftl(follower, leader, rng):
     # add a very small constant to overcome the traffic light problem
     #a += 0.00001*(rng.uniform()-0.5)*ACC
     return a
+
+## Vectorized kernels
+# The functions below work on arrays of speeds and gaps, the last axis
+# running over the cars of a ring (leader of car i is car i-1), and
+# accept the model constants as arguments so that many parameter sets
+# can be simulated at once (e.g. with shape (n_sets, 1) against states
+# of shape (n_sets, n_cars)). `d_min` and `t_safe` define the safety
+# distance d_s = d_min + t_safe*v used by the scalar kernels above.
+
+def acc_ftl_array(v_f, v_l, d, rng=None, alpha_l=ALPHA_L, d_min=1.0, t_safe=1.0, **kwargs):
+    d_s = d_min + t_safe*v_f
+    return np.where(d > d_s,
+                    - alpha_l * (v_f - v_l),
+                    - alpha_l * (d_s - d))
+
+def acc_m_ftl_array(v_f, v_l, d, rng=None, alpha_l=ALPHA_L, alpha_o=ALPHA_O, eps=EPS,
+                    d_min=1.0, t_safe=DELTA_T, **kwargs):
+    d_s = d_min + t_safe*v_f
+    return np.where(d > 20*d_s,
+                    - alpha_o * (v_f - V_MAX),
+                    np.where(d > d_s,
+                             - alpha_l * (v_f - (1+eps) * v_l),
+                             - alpha_l * (d_s - d)))
+
+def acc_opt_speed_array(v_f, v_l, d, rng=None, alpha_o=ALPHA_O, d_min=1.0, t_safe=1.0, **kwargs):
+    d_s = d_min + t_safe*v_l
+    v_s = d - d_min
+    a = np.where(d > 20*d_s,
+                 - alpha_o * (v_f - V_MAX),
+                 np.where(d > d_s,
+                          - alpha_o * (v_f - v_l),
+                          - 5 * alpha_o * (v_f - v_s)))
+    if rng is not None:
+        a = a + 0.00001*(rng.uniform(size=np.shape(a))-0.5)*ACC
+    return a
+
+def get_acc_array_fn(model: str = None):
+    switcher = {
+        'opt_speed': acc_opt_speed_array,
+        'ftl': acc_ftl_array,
+        'm_ftl': acc_m_ftl_array,
+    }
+    return switcher[model]
+
+def fix_distances_array(x, ring):
+    # cars closer than 1 to their leader are put 1 behind it; unlike the
+    # scalar loop all the cars are checked against the old leader positions
+    l_x = np.roll(x, 1, axis=-1)
+    return np.where(ring_distance(x, l_x, ring) < 1, np.fmod(l_x - 1, ring), x)
+
+def evolve_rk2_array(x, v, ring, model, rng=None, v_max=V_MAX, **params):
+    """Vectorized evolve_rk2.
+
+    As in evolve_rk2 the second stage starts from the state advanced by
+    the first half step.
+    """
+    acc_fn = get_acc_array_fn(model)
+    a = acc_fn(v, np.roll(v, 1, axis=-1), ring_distance(x, np.roll(x, 1, axis=-1), ring), rng, **params)
+    x = np.fmod(x + v*DELTA_T/2, ring)
+    v = np.clip(v + a*DELTA_T/2, 0, v_max)
+    a = acc_fn(v, np.roll(v, 1, axis=-1), ring_distance(x, np.roll(x, 1, axis=-1), ring), rng, **params)
+    x = np.fmod(x + v*DELTA_T, ring)
+    v = np.clip(v + a*DELTA_T, 0, v_max)
+    return fix_distances_array(x, ring), v
+
+def evolve_euler_array(x, v, ring, model, rng=None, v_max=V_MAX, **params):
+    """Vectorized evolve_euler."""
+    acc_fn = get_acc_array_fn(model)
+    a = acc_fn(v, np.roll(v, 1, axis=-1), ring_distance(x, np.roll(x, 1, axis=-1), ring), rng, **params)
+    new_v = np.clip(v + a*DELTA_T, 0, v_max)
+    x = np.fmod(x + (v + new_v)*DELTA_T/2, ring)
+    return fix_distances_array(x, ring), new_v
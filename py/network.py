@@ -0,0 +1,432 @@
+from multiprocessing import Pipe, Process
+
+import numpy as np
+
+from models import get_acc_array_fn
+from baselines import DELTA_T, V_MAX
+
+# Gap seen by a car with no leader ahead (e.g. before an open exit): any
+# value beyond the free-flow regime of every model does
+FREE_GAP = 1e9
+
+class RoadNetwork(object):
+    """Directed graph of road segments.
+
+    Every segment has a length (adimensional units, as the ring) and
+    links to the downstream segments a car can move to at its end, with
+    turning weights. Segments without downstream links are open exits,
+    segments with an inflow (cars per unit time) are open entrances.
+    A ring is a segment linked to itself; several segments linked to the
+    same one form a merge, a segment linked to several ones a diverge.
+    """
+    def __init__(self):
+        self.lengths = []
+        self.links = []
+        self.inflow = []
+
+    @property
+    def n_segments(self):
+        return len(self.lengths)
+
+    def add_segment(self, length: float, inflow: float = 0.0):
+        self.lengths.append(float(length))
+        self.links.append(dict())
+        self.inflow.append(float(inflow))
+        return self.n_segments - 1
+
+    def connect(self, upstream: int, downstream: int, weight: float = 1.0):
+        self.links[upstream][downstream] = float(weight)
+
+    @classmethod
+    def ring(cls, length: float):
+        network = cls()
+        network.connect(network.add_segment(length), 0)
+        return network
+
+    @classmethod
+    def corridor(cls, lengths: list, inflow: float = 0.0):
+        """Open highway made of consecutive segments, fed at the first one."""
+        network = cls()
+        for i, length in enumerate(lengths):
+            network.add_segment(length, inflow if i == 0 else 0.0)
+            if i > 0:
+                network.connect(i-1, i)
+        return network
+
+    def routing(self):
+        """Lengths, padded table of the downstream segments (-1 where
+        missing) and cumulative turning probabilities, one row per segment."""
+        width = max([len(links) for links in self.links] + [1])
+        next_ids = np.full((self.n_segments, width), -1, dtype=np.int64)
+        cum = np.ones((self.n_segments, width))
+        for s, links in enumerate(self.links):
+            if len(links) == 0:
+                continue
+            ids = np.array(list(links.keys()))
+            weights = np.array(list(links.values()))
+            next_ids[s, :len(ids)] = ids
+            cum[s, :len(ids)] = np.cumsum(weights)/weights.sum()
+        return np.array(self.lengths), next_ids, cum
+
+def group_ranks(groups):
+    """Index of each entry within its run of equal values of groups."""
+    n = len(groups)
+    start = np.ones(n, dtype=bool)
+    start[1:] = groups[1:] != groups[:-1]
+    return np.arange(n) - np.maximum.accumulate(np.where(start, np.arange(n), 0))
+
+def grouped_cummin(values, groups):
+    """Running minimum of values, restarting at every new value of groups
+    (which must be sorted)."""
+    n = len(values)
+    if n == 0:
+        return values
+    start = np.ones(n, dtype=bool)
+    start[1:] = groups[1:] != groups[:-1]
+    # shift the groups apart, so that a minimum never carries over to the
+    # next group, and pick the running minima by index to keep exact values
+    shifted = values - (2*np.abs(values).max() + 1)*np.cumsum(start)
+    running = np.minimum.accumulate(shifted)
+    return values[np.maximum.accumulate(np.where(shifted <= running, np.arange(n), 0))]
+
+class SegmentBatch(object):
+    """Cars on a set of segments of a network, evolved all at once.
+
+    The cars of all the segments are stored in contiguous arrays sorted by
+    segment and, within a segment, from the front (largest x) to the back,
+    so that the leader of a car is the previous one, as on the ring. The
+    leader of the front car of a segment is the nearest car ahead on the
+    segment it will move to: through empty segments the look-ahead goes
+    on for up to `lookahead` segments, taking the nearest car among the
+    branches of a diverge; past an open exit the road is free.
+    At a junction the cars enter the next segment, one unit apart, as long
+    as there is room behind its last car; the others wait at the end of
+    their segment. When several segments merge, the cars that got furthest
+    go first, ties broken at random.
+    A batch owns a subset of the segments (all by default): cars leaving
+    towards segments owned by another batch are returned by step, and the
+    cars ahead of those segments are given to step as external.
+    """
+    def __init__(self,
+                 network: RoadNetwork = None,
+                 model: str = 'ftl',
+                 owned=None,
+                 seed: int = 51550,
+                 v_max: float = V_MAX,
+                 lookahead: int = 8,
+                 **params):
+        self.lengths, self.next_ids, self.cum = network.routing()
+        n_segments = network.n_segments
+        self.owned = np.ones(n_segments, dtype=bool) if owned is None else np.asarray(owned, dtype=bool)
+        self.inflow = np.where(self.owned, network.inflow, 0.0)
+        self.pending = np.zeros(n_segments) # cars waiting to enter
+        self.acc_fn = get_acc_array_fn(model)
+        self.params = params
+        self.v_max = v_max
+        self.lookahead = lookahead
+        self.rng = np.random.default_rng(seed)
+        self.x = np.zeros(0)
+        self.v = np.zeros(0)
+        self.seg = np.zeros(0, dtype=np.int64)
+        self.next = np.zeros(0, dtype=np.int64)
+        self.n_in = 0
+        self.n_out = 0
+
+    @property
+    def n_segments(self):
+        return len(self.lengths)
+
+    def choose_next(self, seg):
+        """Segment each car moves to at the end of seg (-1 for exits)."""
+        u = self.rng.random(len(seg))
+        idx = (u[:, None] > self.cum[seg]).sum(axis=1)
+        idx = np.minimum(idx, self.cum.shape[1]-1)
+        return self.next_ids[seg, idx]
+
+    def add_cars(self, seg, x, v, next=None):
+        seg = np.asarray(seg, dtype=np.int64)
+        if next is None:
+            next = self.choose_next(seg)
+        self.x = np.concatenate([self.x, x])
+        self.v = np.concatenate([self.v, v])
+        self.seg = np.concatenate([self.seg, seg])
+        self.next = np.concatenate([self.next, next])
+        self.sort()
+
+    def populate(self, spacing: float, speed: float = 0.0):
+        """Put a car every `spacing` units on every owned segment."""
+        segs, xs = [], []
+        for s in np.flatnonzero(self.owned):
+            x = np.arange(0, self.lengths[s], spacing)
+            segs.append(np.full(len(x), s))
+            xs.append(x)
+        seg = np.concatenate(segs) if segs else np.zeros(0, dtype=np.int64)
+        x = np.concatenate(xs) if xs else np.zeros(0)
+        self.add_cars(seg, x, np.full(len(x), float(speed)))
+
+    def sort(self):
+        order = np.lexsort((-self.x, self.seg))
+        self.x, self.v = self.x[order], self.v[order]
+        self.seg, self.next = self.seg[order], self.next[order]
+
+    def offsets(self):
+        return np.searchsorted(self.seg, np.arange(self.n_segments+1))
+
+    def ahead(self, external=None):
+        """Distance from the start of each segment to the nearest car ahead
+        and its speed (inf and v_max if there is none within reach).
+
+        external gives the (segments, distance, speed) arrays of segments
+        owned by other batches.
+        """
+        off = self.offsets()
+        nonempty = off[1:] > off[:-1]
+        tail = off[1:][nonempty] - 1
+        dist = np.full(self.n_segments, np.inf)
+        speed = np.full(self.n_segments, self.v_max)
+        dist[nonempty], speed[nonempty] = self.x[tail], self.v[tail]
+        if external is not None:
+            ext_seg, ext_dist, ext_speed = external
+            dist[ext_seg], speed[ext_seg] = ext_dist, ext_speed
+        # empty owned segments look through the segments they lead to
+        # (index -1 of the padded table picks the inf of the exits)
+        known = nonempty | ~self.owned
+        rows = np.arange(self.n_segments)
+        for _ in range(self.lookahead):
+            next_dist = np.append(dist, np.inf)[self.next_ids]
+            best = np.argmin(next_dist, axis=1)
+            through = self.lengths + next_dist[rows, best]
+            new_dist = np.where(known, dist, through)
+            if np.array_equal(new_dist, dist):
+                break
+            speed = np.where(known, speed, np.append(speed, self.v_max)[self.next_ids][rows, best])
+            dist = new_dist
+        return dist, speed
+
+    def step(self, dt: float = DELTA_T, incoming=None, external=None):
+        """Advance the owned segments by one time step.
+
+        incoming are the (seg, x, v, next) arrays of the cars coming from
+        other batches, external the (segments, distance, speed) arrays of
+        the cars ahead of the segments owned by other batches (see ahead).
+        Returns the (seg, x, v, next) arrays of the cars leaving towards them.
+        """
+        if incoming is not None and len(incoming[0]) > 0:
+            self.add_cars(*incoming)
+        x, v, seg, next = self.x, self.v, self.seg, self.next
+        off = self.offsets()
+        dist, speed = self.ahead(external)
+        # leaders: the previous car, the nearest car ahead of the next
+        # segment for the first car of each segment
+        gap = np.empty(len(x))
+        l_v = np.empty(len(x))
+        gap[1:] = x[:-1] - x[1:]
+        l_v[1:] = v[:-1]
+        first = off[:-1][off[:-1] < off[1:]]
+        d = next[first] # -1 for exits, i.e. the padding
+        ahead_dist = np.append(dist, np.inf)[d]
+        gap[first] = np.minimum(self.lengths[seg[first]] - x[first] + ahead_dist, FREE_GAP)
+        l_v[first] = np.append(speed, self.v_max)[d]
+        # same update as evolve_euler
+        a = self.acc_fn(v, l_v, gap, None, **self.params)
+        new_v = np.clip(v + a*dt, 0, self.v_max)
+        x = x + (v + new_v)*dt/2
+        v = new_v
+        out = x >= self.lengths[seg]
+        exits = out & (next < 0)
+        self.n_out += int(exits.sum())
+        # room at the start of each segment, behind its last car staying;
+        # for the segments of other batches, as seen at the start of the step
+        room = np.full(self.n_segments, np.inf)
+        np.minimum.at(room, seg[~out], x[~out])
+        room[~self.owned] = dist[~self.owned]
+        # vectorized transfers at the junctions: in each segment the cars
+        # enter from the furthest, one unit apart and behind the last car
+        crossing = np.flatnonzero(out & (next >= 0))
+        dest = next[crossing]
+        entry_x = x[crossing] - self.lengths[seg[crossing]]
+        # ties, e.g. between cars waiting at the end of merging segments, are
+        # broken at random
+        order = np.lexsort((self.rng.random(len(dest)), -entry_x, dest))
+        crossing, dest, entry_x = crossing[order], dest[order], entry_x[order]
+        rank = group_ranks(dest)
+        entry_x = np.minimum(grouped_cummin(entry_x + rank, dest), room[dest] - 1) - rank
+        admitted = entry_x >= 0
+        # the others wait at the end of their segment
+        held = crossing[~admitted]
+        x[held] = self.lengths[seg[held]]
+        v[held] = 0
+        moving = crossing[admitted]
+        x[moving] = entry_x[admitted]
+        seg[moving] = dest[admitted]
+        next[moving] = self.choose_next(seg[moving])
+        leaving = np.zeros(len(x), dtype=bool)
+        leaving[moving] = ~self.owned[seg[moving]]
+        outgoing = (seg[leaving], x[leaving], v[leaving], next[leaving])
+        keep = ~(exits | leaving)
+        self.x, self.v, self.seg, self.next = x[keep], v[keep], seg[keep], next[keep]
+        self.sort()
+        self.enter(dt)
+        self.fix_distances()
+        return outgoing
+
+    def enter(self, dt: float):
+        """Let the cars of the open entrances in, one per segment and step
+        at most, when there is room behind the nearest car ahead."""
+        self.pending += self.inflow*dt
+        dist, speed = self.ahead()
+        speed = np.minimum(speed, self.v_max)
+        ready = np.flatnonzero((self.pending >= 1) & (dist > 1 + speed))
+        if len(ready) == 0:
+            return
+        self.pending[ready] -= 1
+        self.n_in += len(ready)
+        self.add_cars(ready, np.zeros(len(ready)), speed[ready])
+
+    def fix_distances(self):
+        # cars closer than 1 to their leader are put 1 behind it; unlike on
+        # the ring the pass is cumulative, x[k] <= x[j] - (k - j) for every
+        # car j ahead of car k on the same segment
+        rank = group_ranks(self.seg)
+        self.x = grouped_cummin(self.x + rank, self.seg) - rank
+
+    def densities(self):
+        """Cars per unit length on each segment."""
+        return np.bincount(self.seg, minlength=self.n_segments)/self.lengths
+
+    def mean_speeds(self):
+        counts = np.bincount(self.seg, minlength=self.n_segments)
+        return np.bincount(self.seg, weights=self.v, minlength=self.n_segments)/np.maximum(counts, 1)
+
+def exported_ahead(batch, exported):
+    dist, speed = batch.ahead()
+    return exported, dist[exported], speed[exported]
+
+def _worker_loop(conn, network, model, owned, seed, exported, params):
+    batch = SegmentBatch(network, model=model, owned=owned, seed=seed, **params)
+    while True:
+        command, args = conn.recv()
+        if command == 'step':
+            incoming, external, n_steps = args
+            outgoing = batch.step(incoming=incoming, external=external)
+            parts = [outgoing]
+            for _ in range(n_steps-1):
+                parts.append(batch.step(external=external))
+            outgoing = tuple(np.concatenate(p) for p in zip(*parts))
+            conn.send((outgoing, exported_ahead(batch, exported)))
+        elif command == 'populate':
+            batch.populate(*args)
+            conn.send(exported_ahead(batch, exported))
+        elif command == 'state':
+            conn.send((batch.seg, batch.x, batch.v, batch.n_in, batch.n_out))
+        elif command == 'stop':
+            conn.close()
+            return
+
+class ParallelNetwork(object):
+    """Evolve a network split in parts, each owned by a worker process.
+
+    At every step the workers get the cars entering their segments from
+    the other parts and the cars ahead of the segments their segments
+    lead to, advance their own segments and send back the cars leaving
+    and the cars ahead of the segments the other parts need. Cars
+    crossing a part boundary enter their new segment at the start of the
+    next step; the room they find there is the one seen at the previous
+    exchange, and the cars of several parts merging into the same segment
+    are only kept apart by the push-back of SegmentBatch.fix_distances.
+    """
+    def __init__(self,
+                 network: RoadNetwork = None,
+                 n_workers: int = 2,
+                 model: str = 'ftl',
+                 partition=None,
+                 seed: int = 51550,
+                 **params):
+        n_segments = network.n_segments
+        if partition is None:
+            # contiguous blocks of segments
+            partition = np.arange(n_segments)*n_workers//max(n_segments, 1)
+        self.partition = np.asarray(partition)
+        self.n_workers = n_workers
+        _, next_ids, _ = network.routing()
+        self.needed = []
+        exported = [set() for _ in range(n_workers)]
+        for w in range(n_workers):
+            ahead = np.unique(next_ids[self.partition == w])
+            ahead = ahead[(ahead >= 0)]
+            ahead = ahead[self.partition[ahead] != w]
+            self.needed.append(ahead)
+            for d in ahead:
+                exported[self.partition[d]].add(int(d))
+        self.dist = np.full(n_segments, np.inf)
+        self.speed = np.full(n_segments, float(params.get('v_max', V_MAX)))
+        self.incoming = [self.empty() for _ in range(n_workers)]
+        self.conns, self.workers = [], []
+        for w in range(n_workers):
+            parent, child = Pipe()
+            process = Process(target=_worker_loop,
+                              args=(child, network, model, self.partition == w, seed + w,
+                                    np.array(sorted(exported[w]), dtype=np.int64), params),
+                              daemon=True)
+            process.start()
+            self.conns.append(parent)
+            self.workers.append(process)
+
+    @staticmethod
+    def empty():
+        return (np.zeros(0, dtype=np.int64), np.zeros(0), np.zeros(0), np.zeros(0, dtype=np.int64))
+
+    def update_ahead(self, ahead):
+        segments, dist, speed = ahead
+        self.dist[segments], self.speed[segments] = dist, speed
+
+    def populate(self, spacing: float, speed: float = 0.0):
+        for conn in self.conns:
+            conn.send(('populate', (spacing, speed)))
+        for conn in self.conns:
+            self.update_ahead(conn.recv())
+
+    def step(self, n_steps: int = 1, exchange_every: int = 1):
+        """Advance by n_steps, exchanging the boundaries every exchange_every steps."""
+        done = 0
+        while done < n_steps:
+            k = min(exchange_every, n_steps - done)
+            for w, conn in enumerate(self.conns):
+                external = (self.needed[w], self.dist[self.needed[w]], self.speed[self.needed[w]])
+                conn.send(('step', (self.incoming[w], external, k)))
+            outgoing = []
+            for conn in self.conns:
+                out, ahead = conn.recv()
+                outgoing.append(out)
+                self.update_ahead(ahead)
+            # route the cars crossing the boundaries to the owners of their segments
+            seg, x, v, next = (np.concatenate(p) for p in zip(*outgoing))
+            owner = self.partition[seg]
+            self.incoming = [(seg[owner == w], x[owner == w], v[owner == w], next[owner == w])
+                             for w in range(self.n_workers)]
+            done += k
+
+    def state(self):
+        """Segments, positions and speeds of all the cars, and the numbers
+        of cars that entered and left the network."""
+        for conn in self.conns:
+            conn.send(('state', None))
+        parts = [conn.recv() for conn in self.conns]
+        seg, x, v = (np.concatenate(p) for p in zip(*[part[:3] for part in parts]))
+        for pending in self.incoming:
+            seg, x, v = (np.concatenate([seg, pending[0]]),
+                         np.concatenate([x, pending[1]]),
+                         np.concatenate([v, pending[2]]))
+        return seg, x, v, sum(part[3] for part in parts), sum(part[4] for part in parts)
+
+    def close(self):
+        for conn in self.conns:
+            conn.send(('stop', None))
+        for process in self.workers:
+            process.join()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
@@ -0,0 +1,98 @@
+from multiprocessing import shared_memory, resource_tracker
+
+import numpy as np
+
+## Shared memory layout
+# A header of HEADER_SIZE int64 values:
+#   [MAGIC, capacity, seq, writing]
+# followed by two float64 buffers of 3 + 2*capacity values each:
+#   [n, real_time, radius, x[capacity], speed[capacity]]
+# `seq` is the number of published frames, the latest one lives in buffer
+# seq % 2. Before filling buffer (seq+1) % 2 the writer sets `writing` to
+# seq+1, and only then bumps `seq`: a reader that got frame s is sure its
+# buffer was not touched as long as `writing` stays below s+2.
+MAGIC = 0x4d4e4d53 # 'MNMS'
+HEADER_SIZE = 4
+FRAME_HEADER = 3
+
+def _layout(shm, capacity):
+    header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=shm.buf)
+    frames = np.ndarray((2, FRAME_HEADER + 2*capacity), dtype=np.float64,
+                        buffer=shm.buf, offset=header.nbytes)
+    return header, frames
+
+def _size(capacity):
+    return 8*HEADER_SIZE + 8*2*(FRAME_HEADER + 2*capacity)
+
+class StatePublisher(object):
+    """Publish positions and speeds of the cars to shared memory.
+
+    The writer never waits for the readers: publishing a frame is a copy
+    of the two fields into the back buffer and a counter update.
+    """
+    def __init__(self, name: str = None, capacity: int = 1000):
+        self.capacity = capacity
+        self.shm = shared_memory.SharedMemory(name=name, create=True, size=_size(capacity))
+        self.name = self.shm.name
+        self.header, self.frames = _layout(self.shm, capacity)
+        self.frames[:] = 0
+        self.header[:] = [MAGIC, capacity, 0, 0]
+
+    def publish(self, x, speed, real_time: float = 0.0, radius: float = 0.0):
+        n = len(x)
+        if n > self.capacity:
+            raise ValueError('Cannot publish {} cars, the capacity is {}'.format(n, self.capacity))
+        seq = int(self.header[2])
+        self.header[3] = seq + 1
+        frame = self.frames[(seq + 1) % 2]
+        frame[:FRAME_HEADER] = [n, real_time, radius]
+        frame[FRAME_HEADER:FRAME_HEADER+n] = x
+        frame[FRAME_HEADER+self.capacity:FRAME_HEADER+self.capacity+n] = speed
+        self.header[2] = seq + 1
+
+    def close(self):
+        del self.header, self.frames
+        self.shm.close()
+        self.shm.unlink()
+
+class StateReader(object):
+    """Map the buffers of a StatePublisher living in another process.
+
+    Frames are returned as views on the shared memory, without copies;
+    check `valid(seq)` once done with them to know whether the writer
+    overwrote the frame in the meantime.
+    """
+    def __init__(self, name: str):
+        try:
+            self.shm = shared_memory.SharedMemory(name=name, track=False)
+        except TypeError:
+            # python < 3.13 always tracks the segment and would destroy
+            # it when the reader exits
+            self.shm = shared_memory.SharedMemory(name=name)
+            resource_tracker.unregister(self.shm._name, 'shared_memory')
+        header = np.ndarray((HEADER_SIZE,), dtype=np.int64, buffer=self.shm.buf)
+        if header[0] != MAGIC:
+            raise ValueError('{} is not a simulation state buffer'.format(name))
+        self.capacity = int(header[1])
+        self.header, self.frames = _layout(self.shm, self.capacity)
+
+    @property
+    def seq(self):
+        return int(self.header[2])
+
+    def frame(self):
+        """Latest frame as (seq, n, real_time, radius, x, speed)."""
+        seq = self.seq
+        frame = self.frames[seq % 2]
+        n, real_time, radius = frame[:FRAME_HEADER]
+        n = int(n)
+        x = frame[FRAME_HEADER:FRAME_HEADER+n]
+        speed = frame[FRAME_HEADER+self.capacity:FRAME_HEADER+self.capacity+n]
+        return seq, n, real_time, radius, x, speed
+
+    def valid(self, seq: int):
+        return int(self.header[3]) < seq + 2
+
+    def close(self):
+        del self.header, self.frames
+        self.shm.close()
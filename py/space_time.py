@@ -0,0 +1,38 @@
+import numpy as np
+
+from util import ring_bins
+
+class SpaceTimeBuffer(object):
+    """Fixed-size circular buffer of speed profiles along the ring.
+
+    Every push rasterises the current speeds onto n_bins position bins
+    and writes them into the next row of a preallocated (n_rows, n_bins)
+    array, overwriting the oldest one. Bins without cars are NaN.
+    The memory used never changes, however long the run.
+    """
+    def __init__(self, n_bins: int = 256, n_rows: int = 500):
+        self.n_bins = n_bins
+        self.n_rows = n_rows
+        self.image = np.full((n_rows, n_bins), np.nan, dtype=np.float32)
+        self.row = 0 # next row to be written
+        self.n_pushed = 0
+
+    def push(self, x, speed, ring: float):
+        density, mean_speed = ring_bins(x, speed, ring, self.n_bins)
+        row = self.image[self.row]
+        row[:] = mean_speed
+        row[density == 0] = np.nan
+        self.row = (self.row + 1) % self.n_rows
+        self.n_pushed += 1
+        return row
+
+    def ordered(self):
+        """Copy of the buffer with the rows in chronological order."""
+        if self.n_pushed < self.n_rows:
+            return self.image[:self.n_pushed].copy()
+        return np.roll(self.image, -self.row, axis=0)
+
+    def clear(self):
+        self.image[:] = np.nan
+        self.row = 0
+        self.n_pushed = 0
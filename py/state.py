@@ -0,0 +1,243 @@
+import pathlib
+
+import numpy as np
+from math import pi as PI
+
+from util import distance_field, speed_field, position_field, dump_fields
+from car_class import Car
+from models import evolve_euler, evolve_rk2, model_ca
+from perturbations import get_pert_fn
+from lwr import LWR, FundamentalDiagram
+from baselines import D_CM_MIN, V_MAX, ACC, TAU, DELTA_T
+
+log_file = "simulation_log.txt"
+
+class Simulation(object):
+    """State of the cars on the ring and its evolution.
+
+    This class holds everything needed to step a model forward and
+    never imports Qt, so that it can be used by scripts and headless
+    runs. The GUI (see visualizer.py) is built on top of it.
+    """
+    def __init__(self,
+                 model: str = None,
+                 n_cars: int = None,
+                 radius: float = None,
+                 filling: float = None,
+                 start_speed: float = None,
+                 scheme: str = None,
+                 path_to_out: pathlib.Path = None,
+                 seed: int = 51550,
+                 n_cells: int = 1000,
+                 fd_model: str = 'ftl'):
+        self.path_to_out = path_to_out
+        self.model = model
+        self.scheme = scheme
+        self.rng = np.random.default_rng(seed)
+
+        self.real_time = 0.0
+        self.n = n_cars  # number of cars
+        self.traffic_light = False
+        self.v_max = V_MAX # already in adimensional units
+        self.start_speed = start_speed
+        self.filling = filling
+        self.thetas = np.linspace(0.0, 2*PI*self.filling, self.n, endpoint=False)
+        self.radius = radius*1000/D_CM_MIN # radius is given in km
+        self.ring = 2*PI*self.radius
+        self.delta_t = DELTA_T
+        self.publisher = None
+        self.recorder = None
+        self.record_every = 1
+        self.n_steps = 0
+        # the macroscopic model evolves a density on n_cells cells, its
+        # fundamental diagram is the equilibrium one of fd_model
+        self.n_cells = n_cells
+        self.fd_model = fd_model
+        self.engine = None
+        if self.path_to_out is not None:
+            self.log_initial_conditions(radius)
+
+        self.cars = []
+        self.init_cars()
+
+    def log_initial_conditions(self, radius: float):
+        speed_in_kmh = V_MAX*3.6*D_CM_MIN/TAU # conversion to km/h
+        with open(self.path_to_out/log_file, 'a') as file:
+            print('Initial conditions\n', file=file)
+            print('\tInitial number of cars {}\n'.format(self.n), file=file)
+            print('\tMax Speed {} km/h\n'.format(speed_in_kmh), file=file)
+            print('\tMax safe distance (not for CA model) {} m\n'.format((1+V_MAX)*D_CM_MIN), file=file)
+            print('\tMin safe distance (not for CA model) {} m\n'.format(D_CM_MIN), file=file)
+            print('\tInitial angles (rad) {}\n'.format(self.thetas), file=file)
+            print('\tInitial radius {} m\n'.format(radius*1000), file=file)
+            print('\tInitial positions (u) {}\n'.format(self.radius*self.thetas), file=file)
+            print('\tInitial positions (m) {}\n'.format(self.radius*self.thetas*D_CM_MIN), file=file)
+            print('\tInitial ring length {} m\n'.format(self.ring*D_CM_MIN), file=file)
+            print('\tSpace per car {} m\n'.format(self.ring*D_CM_MIN/self.n), file=file)
+            print('\tInitial speed {} u\n'.format(V_MAX), file=file)
+            print('\tInitial speed {} km/h\n'.format(V_MAX*3.6*D_CM_MIN/TAU), file=file)
+
+    def init_cars(self):
+        if self.model == 'lwr':
+            self.engine = LWR(fd=FundamentalDiagram.from_model(self.fd_model),
+                              ring=self.ring,
+                              n_cars=self.n,
+                              filling=self.filling,
+                              n_cells=self.n_cells)
+            self.cars = []
+            return
+        new_cars = []
+        for i in range(self.n):
+            reactivity = np.random.choice(range(20),
+                                p = [0.05]*20,
+                                size = 1)
+            c = Car(x=self.radius*self.thetas[self.n-1-i],
+                    radius=self.radius,
+                    theta=self.thetas[self.n-1-i],
+                    speed=self.start_speed,
+                    v_max=self.v_max,
+                    reactivity=reactivity)
+            new_cars.append(c)
+        self.cars = new_cars
+
+    def step(self):
+        """Advance the system by one time step."""
+        self.real_time += DELTA_T
+        self.n_steps += 1
+        if self.model == 'lwr':
+            self.engine.set_traffic_light(self.traffic_light)
+            self.engine.step()
+        else:
+            if self.traffic_light:
+                self.cars[0].v_max = max(self.cars[0].v_max - ACC, 0)
+            else:
+                self.cars[0].v_max = V_MAX
+            if self.model == 'ca':
+                self.cars = model_ca(self.cars, self.rng)
+            elif self.scheme == 'rk2':
+                self.cars = evolve_rk2(self.cars, self.rng, self.model)
+            elif self.scheme == 'euler':
+                self.cars = evolve_euler(self.cars, self.rng, self.model)
+        if self.publisher is not None:
+            self.publish()
+        if self.recorder is not None and self.n_steps % self.record_every == 0:
+            self.recorder.write(self.positions(), self.speeds(), self.real_time)
+
+    def record(self, path: pathlib.Path, every: int = 1, **kwargs):
+        """Record the trajectory every `every` steps in a compressed file.
+
+        kwargs are passed to trajectory.TrajectoryWriter.
+        """
+        from trajectory import TrajectoryWriter
+        self.recorder = TrajectoryWriter(path, ring=self.ring, n_cars=len(self.positions()),
+                                         v_max=self.v_max, **kwargs)
+        self.record_every = every
+        self.recorder.write(self.positions(), self.speeds(), self.real_time)
+        self.log('Recording the trajectory in {}'.format(path))
+
+    def stop_recording(self):
+        if self.recorder is not None:
+            self.recorder.close()
+            self.recorder = None
+
+    def share(self, name: str = None, capacity: int = None):
+        """Publish the state to shared memory at every step.
+
+        An external viewer (see viewer.py) can then attach to the buffers
+        by name at any time, without slowing down the simulation.
+        """
+        from shared_state import StatePublisher
+        if capacity is None:
+            capacity = max(self.n, 1000)
+        if self.model == 'lwr':
+            capacity = max(capacity, self.n_cells)
+        self.publisher = StatePublisher(name=name, capacity=capacity)
+        self.publish()
+        self.log('Sharing the state as {}'.format(self.publisher.name))
+        return self.publisher.name
+
+    def publish(self):
+        self.publisher.publish(self.positions(), self.speeds(), self.real_time, self.radius)
+
+    def unshare(self):
+        if self.publisher is not None:
+            self.publisher.close()
+            self.publisher = None
+
+    def positions(self):
+        """Positions along the ring of the cars (of the cells for lwr)."""
+        if self.model == 'lwr':
+            return self.engine.positions()
+        return position_field(self.cars)
+
+    def speeds(self):
+        """Speeds of the cars (equilibrium speeds of the cells for lwr)."""
+        if self.model == 'lwr':
+            return self.engine.speeds()
+        return speed_field(self.cars)
+
+    def distances(self):
+        """Distances from the leaders (mean gap 1/density of the cells for lwr,
+        NaN for the empty ones)."""
+        if self.model == 'lwr':
+            return self.engine.distances()
+        return distance_field(self.cars)
+
+    def weights(self):
+        """Number of cars behind each value of the fields (one per car, the
+        cars in each cell for lwr), to average the fields over the cars."""
+        if self.model == 'lwr':
+            return self.engine.weights()
+        return np.ones(len(self.cars))
+
+    def mean_speed(self):
+        return np.average(self.speeds(), weights=self.weights())
+
+    def mean_distance(self):
+        # the gaps of the cars add up to the ring
+        return self.ring/self.weights().sum()
+
+    def run(self, n_steps: int, monitor=None):
+        """Advance the system by at most n_steps time steps.
+
+        If a convergence monitor is given (see convergence.py), the run
+        stops as soon as it detects a steady or periodic regime.
+        Returns the number of steps performed.
+        """
+        for i in range(n_steps):
+            self.step()
+            if monitor is not None and monitor.update(self):
+                return i+1
+        return n_steps
+
+    def log(self, message: str):
+        if self.path_to_out is None:
+            return
+        with open(self.path_to_out/log_file, 'a') as file:
+            print(message, file=file)
+
+    def pause_resume(self):
+        if self.delta_t == DELTA_T:
+            self.delta_t = 0.0
+            command = 'Pause'
+        else:
+            self.delta_t = DELTA_T
+            command = 'Resume'
+        self.log(command)
+
+    def set_traffic_light(self):
+        self.traffic_light = not self.traffic_light
+
+    def external_perturbation(self, id):
+        self.pause_resume()
+        if self.model == 'lwr':
+            self.engine.perturb(id, self.rng)
+        else:
+            ext_pert_fn = get_pert_fn(self.rng, id)
+            self.cars = ext_pert_fn(self.cars)
+        self.dump()
+        self.pause_resume()
+
+    def dump(self):
+        dump_fields(self.path_to_out, self.real_time,
+                    self.distances(), self.speeds(), self.positions())
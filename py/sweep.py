@@ -0,0 +1,96 @@
+from functools import partial
+from multiprocessing import Pool
+import itertools
+import pathlib
+
+import numpy as np
+
+from util import build_parser, dump_result_dict
+from simulation import RUN_ARGS, run_config
+from cache import ResultCache
+
+def parse_bool(value: str):
+    if value.lower() in ('true', 'yes', '1'):
+        return True
+    if value.lower() in ('false', 'no', '0'):
+        return False
+    raise ValueError('Expected a boolean, got {}'.format(value))
+
+def parse_axis(spec: str, parser):
+    """Parse an axis of the sweep, given as name=start:stop:step or name=v1,v2,...
+
+    The values are converted with the type of the option name of the
+    parser; flags (e.g. converge) take true/false values.
+    """
+    name, values = spec.split('=', 1)
+    actions = {action.dest: action for action in parser._actions}
+    if name not in RUN_ARGS:
+        raise ValueError('Cannot sweep over {}, choose among {}'.format(name, RUN_ARGS))
+    if isinstance(actions[name].default, bool):
+        if ':' in values:
+            raise ValueError('{} is a flag, give its values as true,false'.format(name))
+        cast = parse_bool
+    else:
+        cast = actions[name].type or type('')
+    if ':' in values:
+        start, stop, step = map(float, values.split(':'))
+        values = np.arange(start, stop + step/2, step)
+    else:
+        values = values.split(',')
+    return name, [cast(v) for v in values]
+
+def run_point(config: dict, cache_folder: str = None, cache_size: float = 1024):
+    cache = None
+    if cache_folder is not None:
+        cache = ResultCache(cache_folder, max_bytes=int(cache_size*2**20))
+    result, _ = run_config(config, cache=cache)
+    return result
+
+def sweep(base: dict, axes: list, workers: int = 1, cache_folder: str = None,
+          cache_size: float = 1024):
+    """Run headless every point of the grid spanned by axes.
+
+    axes is a list of (name, values); the other values of the
+    configuration are taken from base. Points found in the cache are
+    not computed again. Returns the configurations and their summaries.
+    """
+    names = [name for name, _ in axes]
+    configs = [dict(base, **dict(zip(names, point)))
+               for point in itertools.product(*[values for _, values in axes])]
+    fn = partial(run_point, cache_folder=cache_folder, cache_size=cache_size)
+    if workers > 1:
+        with Pool(workers) as pool:
+            return configs, pool.map(fn, configs)
+    return configs, list(map(fn, configs))
+
+
+if __name__ == '__main__':
+    parser = build_parser()
+    parser.description = 'Run headless simulations over a grid of parameters.'
+    parser.add_argument('--sweep',
+                        dest='sweep',
+                        required=True,
+                        nargs='+',
+                        help='Set the axes of the sweep, as name=start:stop:step or name=v1,v2,...\n'
+                        'e.g. --sweep number_of_cars=10:200:10 radius=0.5,1,2')
+    parser.add_argument('-w', '--workers',
+                        dest='workers',
+                        required=False,
+                        type=int,
+                        default=1,
+                        action='store',
+                        help='Set the number of processes running the points')
+    args = parser.parse_args()
+    axes = [parse_axis(spec, parser) for spec in args.sweep]
+    base = {name: getattr(args, name) for name in RUN_ARGS}
+    if args.out_folder is None:
+        path_to_out = pathlib.Path(__file__).parent.parent.absolute()/'output'
+    else:
+        path_to_out = pathlib.Path(args.out_folder)
+    path_to_out.mkdir(parents=True, exist_ok=True)
+    configs, results = sweep(base, axes, workers=args.workers,
+                             cache_folder=args.cache, cache_size=args.cache_size)
+    for i, (config, result) in enumerate(zip(configs, results)):
+        result['timestamp'] = i
+        result.update({name: config[name] for name, _ in axes})
+        dump_result_dict('sweep_'+args.model, result, folder=path_to_out)
@@ -0,0 +1,227 @@
+import json
+import pathlib
+import struct
+import zlib
+
+import numpy as np
+
+from baselines import V_MAX
+
+try:
+    import lz4.frame as lz4
+except ImportError:
+    lz4 = None
+
+## File layout
+#   MAGIC | blocks ... | index (JSON) | index offset (uint64) | MAGIC
+# Positions are stored as 32 bit fixed point fractions of the ring, so
+# that the wrap around the ring is the natural uint32 overflow: the first
+# frame of a block is stored as is, the others as int32 deltas from the
+# previous frame. Speeds are quantised as uint16 fractions of v_max or as
+# float16. Every block is byte-shuffled and compressed on its own, the
+# index keeps the offset and the first frame of each block for random
+# access.
+MAGIC = b'MNMT'
+VERSION = 1
+POS_SCALE = 2.0**32
+
+CODECS = {
+    'zlib': (lambda data: zlib.compress(data, 1), zlib.decompress),
+}
+if lz4 is not None:
+    CODECS['lz4'] = (lz4.compress, lz4.decompress)
+
+def default_codec():
+    return 'lz4' if 'lz4' in CODECS else 'zlib'
+
+def shuffle(a):
+    """Group the bytes of the elements by significance, which compresses
+    much better for small integers."""
+    return np.ascontiguousarray(a.view(np.uint8).reshape(-1, a.itemsize).T).tobytes()
+
+def unshuffle(data, dtype, shape):
+    itemsize = np.dtype(dtype).itemsize
+    a = np.frombuffer(data, dtype=np.uint8).reshape(itemsize, -1).T
+    return np.ascontiguousarray(a).view(dtype).reshape(shape)
+
+class TrajectoryWriter(object):
+    """Encode positions and speeds of n_cars cars, frame by frame.
+
+    Frames are accumulated in preallocated buffers and a block is
+    compressed every block_size frames.
+    """
+    def __init__(self,
+                 path: pathlib.Path = None,
+                 ring: float = None,
+                 n_cars: int = None,
+                 v_max: float = V_MAX,
+                 speed_dtype: str = 'uint16',
+                 block_size: int = 256,
+                 codec: str = None):
+        if speed_dtype not in ('uint16', 'float16'):
+            raise ValueError('Unknown speed encoding {}'.format(speed_dtype))
+        self.codec = codec or default_codec()
+        self.compress = CODECS[self.codec][0]
+        self.meta = {'version': VERSION, 'ring': ring, 'n_cars': n_cars, 'v_max': v_max,
+                     'speed_dtype': speed_dtype, 'block_size': block_size,
+                     'codec': self.codec}
+        self.ring = ring
+        self.n_cars = n_cars
+        self.v_max = v_max
+        self.speed_dtype = speed_dtype
+        self.block_size = block_size
+        self.positions = np.zeros((block_size, n_cars), dtype=np.uint32)
+        self.speeds = np.zeros((block_size, n_cars), dtype=speed_dtype)
+        self.times = np.zeros(block_size)
+        self.n_buffered = 0
+        self.n_frames = 0
+        self.index = []
+        self.file = open(path, 'wb')
+        self.file.write(MAGIC)
+
+    def write(self, x, speed, real_time: float = 0.0):
+        if len(x) != self.n_cars:
+            raise ValueError('Expected {} cars, got {}'.format(self.n_cars, len(x)))
+        i = self.n_buffered
+        # quantise into the current block
+        q = np.fmod(np.asarray(x, dtype=float), self.ring)/self.ring
+        self.positions[i] = np.mod(np.rint(q*POS_SCALE), POS_SCALE).astype(np.uint32)
+        if self.speed_dtype == 'uint16':
+            self.speeds[i] = np.rint(np.clip(np.asarray(speed)/self.v_max, 0, 1)*65535)
+        else:
+            self.speeds[i] = speed
+        self.times[i] = real_time
+        self.n_buffered += 1
+        self.n_frames += 1
+        if self.n_buffered == self.block_size:
+            self.flush()
+
+    def flush(self):
+        n = self.n_buffered
+        if n == 0:
+            return
+        pos = self.positions[:n]
+        # uint32 differences wrap around the ring, read back as int32
+        deltas = np.diff(pos, axis=0).view(np.int32)
+        payload = b''.join([self.times[:n].tobytes(),
+                            pos[0].tobytes(),
+                            shuffle(deltas),
+                            shuffle(self.speeds[:n])])
+        data = self.compress(payload)
+        self.index.append({'start': self.n_frames - n, 'n_frames': n,
+                           'offset': self.file.tell(), 'length': len(data),
+                           'time': float(self.times[0])})
+        self.file.write(data)
+        self.n_buffered = 0
+
+    def close(self):
+        self.flush()
+        offset = self.file.tell()
+        self.file.write(json.dumps({'meta': self.meta, 'blocks': self.index}).encode())
+        self.file.write(struct.pack('<Q', offset))
+        self.file.write(MAGIC)
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
+
+class TrajectoryReader(object):
+    """Random access to a trajectory written by TrajectoryWriter.
+
+    Frames are decoded a block at a time and returned as arrays of
+    positions (along the ring) and speeds, in simulation units.
+    """
+    def __init__(self, path: pathlib.Path):
+        self.file = open(path, 'rb')
+        if self.file.read(len(MAGIC)) != MAGIC:
+            raise ValueError('{} is not a trajectory file'.format(path))
+        self.file.seek(-8-len(MAGIC), 2)
+        offset, = struct.unpack('<Q', self.file.read(8))
+        end = self.file.tell() - 8
+        self.file.seek(offset)
+        index = json.loads(self.file.read(end - offset))
+        self.meta = index['meta']
+        self.blocks = index['blocks']
+        self.decompress = CODECS[self.meta['codec']][1]
+        self.starts = np.array([block['start'] for block in self.blocks], dtype=int)
+        self.block_times = np.array([block['time'] for block in self.blocks])
+        self.cached = (None, None)
+
+    def __len__(self):
+        if len(self.blocks) == 0:
+            return 0
+        return self.blocks[-1]['start'] + self.blocks[-1]['n_frames']
+
+    def decode_block(self, b: int):
+        """Times, positions and speeds of the frames of block b."""
+        if self.cached[0] == b:
+            return self.cached[1]
+        block = self.blocks[b]
+        n, n_cars = block['n_frames'], self.meta['n_cars']
+        self.file.seek(block['offset'])
+        payload = self.decompress(self.file.read(block['length']))
+        times = np.frombuffer(payload, dtype=np.float64, count=n)
+        offset = times.nbytes
+        first = np.frombuffer(payload, dtype=np.uint32, count=n_cars, offset=offset)
+        offset += first.nbytes
+        size = 4*(n-1)*n_cars
+        deltas = unshuffle(payload[offset:offset+size], np.int32, (n-1, n_cars))
+        offset += size
+        speeds = unshuffle(payload[offset:], self.meta['speed_dtype'], (n, n_cars))
+        # uint32 cumulative sums wrap around the ring as in the encoder
+        pos = np.empty((n, n_cars), dtype=np.uint32)
+        pos[0] = first
+        pos[1:] = deltas.view(np.uint32)
+        pos = np.cumsum(pos, axis=0, dtype=np.uint32)
+        x = pos/POS_SCALE*self.meta['ring']
+        if self.meta['speed_dtype'] == 'uint16':
+            v = speeds/65535*self.meta['v_max']
+        else:
+            v = speeds.astype(float)
+        self.cached = (b, (times.copy(), x, v))
+        return self.cached[1]
+
+    def read(self, start: int = 0, stop: int = None):
+        """Times, positions and speeds of frames start to stop (excluded)."""
+        stop = len(self) if stop is None else min(stop, len(self))
+        out = []
+        b = max(int(np.searchsorted(self.starts, start, side='right')) - 1, 0)
+        while b < len(self.blocks) and self.starts[b] < stop:
+            times, x, v = self.decode_block(b)
+            i0 = max(start - self.starts[b], 0)
+            i1 = min(stop - self.starts[b], len(times))
+            out.append((times[i0:i1], x[i0:i1], v[i0:i1]))
+            b += 1
+        if len(out) == 0:
+            n_cars = self.meta['n_cars']
+            return np.zeros(0), np.zeros((0, n_cars)), np.zeros((0, n_cars))
+        return tuple(np.concatenate(parts) for parts in zip(*out))
+
+    def frame(self, i: int):
+        """Positions and speeds of frame i (negative i count from the end)."""
+        n = len(self)
+        if not -n <= i < n:
+            raise IndexError('Frame {} out of range for a trajectory of {} frames'.format(i, n))
+        i = i % n
+        b = int(np.searchsorted(self.starts, i, side='right')) - 1
+        times, x, v = self.decode_block(b)
+        return x[i - self.starts[b]], v[i - self.starts[b]]
+
+    def at_time(self, t: float):
+        """Positions and speeds of the last frame at or before time t."""
+        b = max(int(np.searchsorted(self.block_times, t, side='right')) - 1, 0)
+        times, x, v = self.decode_block(b)
+        i = max(int(np.searchsorted(times, t, side='right')) - 1, 0)
+        return x[i], v[i]
+
+    def close(self):
+        self.file.close()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *args):
+        self.close()
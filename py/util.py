@@ -1,20 +1,23 @@
-from argparse import RawTextHelpFormatter, ArgumentParser
-from os import spawnlpe
-from typing import Dict
+from typing import Dict, TYPE_CHECKING
 import pathlib
 import math
 from math import pi as PI
 import numpy as np
 
-from car_class import Car
 from baselines import M_TO_U
 
-def parse_args():
-    """Parse the arguments passed."""
+if TYPE_CHECKING:
+    from car_class import Car
+
+def build_parser():
+    """Build the parser of the arguments of simulation.py."""
+    # argparse is only needed by the entry point, keep it off the import path
+    from argparse import RawTextHelpFormatter, ArgumentParser
     description = 'This python program provides a UI to make some experiments' \
         ' on different traffic models on a closed route, i.e. a circle.\n' \
         'The user is able to choose one out of 4 different microscopic traffic models:\n' \
         '1. Follow-the-Leader\n2. Modifed Follow-the-Leader\n3. Optimal Speed\n4. Cellular Automata (discrete)\n' \
+        'or the macroscopic Lighthill-Whitham-Richards model (lwr), solved on a grid with the Godunov scheme.\n' \
         'The user can also choose the number of cars to simulate, the radius of the circle and many other parameters.\n\n' \
         'A wider explanation of this program is available here: ' # TODO: put link to repo readme
     parser = ArgumentParser(description=description,
@@ -38,7 +41,7 @@ def parse_args():
                         required=False,
                         type=type(''),
                         default='ftl',
-                        choices=['ftl', 'ca', 'opt_speed', 'm_ftl'],
+                        choices=['ftl', 'ca', 'opt_speed', 'm_ftl', 'lwr'],
                         action='store',
                         help='Set the model of the simulation')
     parser.add_argument('-s', '--scheme',
@@ -49,6 +52,22 @@ def parse_args():
                         choices=['rk2', 'euler'],
                         action='store',
                         help='Set the scheme for the evolution')
+    parser.add_argument('--cells',
+                        dest='cells',
+                        required=False,
+                        type=int,
+                        default=1000,
+                        action='store',
+                        help='Set the number of cells of the grid of the lwr model')
+    parser.add_argument('--fd_model',
+                        dest='fd_model',
+                        required=False,
+                        type=type(''),
+                        default='ftl',
+                        choices=['ftl', 'opt_speed', 'm_ftl'],
+                        action='store',
+                        help='Set the microscopic model whose equilibrium gives the\n'
+                        'fundamental diagram of the lwr model')
     parser.add_argument('-t', '--ui_update_ms',
                         dest='ui_update_ms',
                         required=False,
@@ -69,41 +88,193 @@ def parse_args():
                         type=type(''),
                         action='store',
                         help='Set the folder where the outputs will be dumped')
-    args = parser.parse_args()
-    return args
+    parser.add_argument('--headless',
+                        dest='headless',
+                        required=False,
+                        default=False,
+                        action='store_true',
+                        help='Run the simulation without the UI (Qt is never imported)')
+    parser.add_argument('--steps',
+                        dest='steps',
+                        required=False,
+                        type=int,
+                        default=1000,
+                        action='store',
+                        help='Set the number of steps of a headless run')
+    parser.add_argument('--seed',
+                        dest='seed',
+                        required=False,
+                        type=int,
+                        default=51550,
+                        action='store',
+                        help='Set the seed of the random number generator')
+    parser.add_argument('--lod_threshold',
+                        dest='lod_threshold',
+                        required=False,
+                        type=int,
+                        default=20000,
+                        action='store',
+                        help='Set the number of cars above which the UI draws aggregated data\n'
+                        '(binned ring band, min/max/mean per pixel column) instead of single cars')
+    parser.add_argument('--space_time_rows',
+                        dest='space_time_rows',
+                        required=False,
+                        type=int,
+                        default=500,
+                        action='store',
+                        help='Set the number of steps kept in the space-time diagram')
+    parser.add_argument('--cache',
+                        dest='cache',
+                        required=False,
+                        type=type(''),
+                        action='store',
+                        help='Set the folder of the cache of headless results: runs\n'
+                        'with a configuration already computed are not repeated')
+    parser.add_argument('--cache_size',
+                        dest='cache_size',
+                        required=False,
+                        type=float,
+                        default=1024,
+                        action='store',
+                        help='Set the maximum size of the cache (in MB)')
+    parser.add_argument('--record',
+                        dest='record',
+                        required=False,
+                        type=type(''),
+                        action='store',
+                        help='Record the trajectory of a headless run in the given\n'
+                        'compressed file (see trajectory.py)')
+    parser.add_argument('--record_every',
+                        dest='record_every',
+                        required=False,
+                        type=int,
+                        default=1,
+                        action='store',
+                        help='Set the number of steps between two recorded frames')
+    parser.add_argument('--speed_dtype',
+                        dest='speed_dtype',
+                        required=False,
+                        type=type(''),
+                        default='uint16',
+                        choices=['uint16', 'float16'],
+                        action='store',
+                        help='Set the quantisation of the recorded speeds')
+    parser.add_argument('--share',
+                        dest='share',
+                        required=False,
+                        type=type(''),
+                        action='store',
+                        help='Publish the state in shared memory with the given name,\n'
+                        'so that viewer.py can attach to the run')
+    parser.add_argument('--converge',
+                        dest='converge',
+                        required=False,
+                        default=False,
+                        action='store_true',
+                        help='Stop a headless run as soon as it reaches a steady or periodic regime\n'
+                        '(--steps is then the maximum number of steps)')
+    parser.add_argument('--window',
+                        dest='window',
+                        required=False,
+                        type=int,
+                        default=50,
+                        action='store',
+                        help='Set the number of samples of the windows used to detect convergence')
+    parser.add_argument('--rtol',
+                        dest='rtol',
+                        required=False,
+                        type=float,
+                        default=1e-2,
+                        action='store',
+                        help='Set the relative amplitude above which the mean speed is considered oscillating')
+    return parser
+
+def parse_args(argv: list = None):
+    """Parse the arguments passed."""
+    return build_parser().parse_args(argv)
 
 def ring_distance_1d(f_x: float, l_x: float, ring: float):
     d = l_x - f_x if l_x >= f_x else l_x + ring - f_x
     return d
 
+def ring_distance(f_x, l_x, ring):
+    """Vectorized ring_distance_1d."""
+    return np.where(l_x >= f_x, l_x - f_x, l_x + ring - f_x)
+
 def moving_average(x, w):
     return np.convolve(x, np.ones(w), 'same') / w
 
-def average_speed(cars: list[Car]):
+def average_speed(cars: list['Car']):
     avg = 0
     for car in cars:
         avg += car.speed
     return avg/len(cars)
 
-def distance_field(cars: list[Car]):
-    d = []
-    radius = cars[0].radius
-    for i in range(len(cars)):
-        f_idx, l_idx = i, int(math.fmod(i-1,len(cars)))
-        d.append(ring_distance_1d(cars[f_idx].x, cars[l_idx].x, 2*PI*radius))
-    return np.array(d)
+def distance_field(cars: list['Car']):
+    x = position_field(cars)
+    if len(x) == 0:
+        return x
+    ring = 2*PI*cars[0].radius
+    # the leader of the i-th car is the (i-1)-th one
+    return ring_distance(x, np.roll(x, 1), ring)
 
-def speed_field(cars: list[Car]):
-    return np.array([float(car.speed) for car in cars])
+def speed_field(cars: list['Car']):
+    return np.fromiter((car.speed for car in cars), dtype=float, count=len(cars))
 
-def compute_position(car: Car):
+def position_field(cars: list['Car']):
+    return np.fromiter((car.x for car in cars), dtype=float, count=len(cars))
+
+def compute_position(car: 'Car'):
     x = M_TO_U * car.radius * \
         math.cos(car.x / car.radius)
     y = M_TO_U * car.radius * \
         math.sin(car.x / car.radius)
     return np.vstack([x, y, .0]).transpose()
 
-def dump_result_dict(filename: str, result: Dict, verbose: int = 0):
+def compute_positions(x, radius: float):
+    """Vectorized compute_position for an array of ring coordinates."""
+    pts = np.zeros((len(x), 3))
+    pts[:, 0] = M_TO_U * radius * np.cos(x / radius)
+    pts[:, 1] = M_TO_U * radius * np.sin(x / radius)
+    return pts
+
+def ring_bins(x, speed, ring: float, n_bins: int):
+    """Density (cars per unit length) and mean speed in n_bins along the ring.
+
+    Empty bins get a zero mean speed.
+    """
+    bins = np.clip((x/ring*n_bins).astype(int), 0, n_bins-1)
+    counts = np.bincount(bins, minlength=n_bins)
+    speed_sum = np.bincount(bins, weights=speed, minlength=n_bins)
+    mean_speed = speed_sum/np.maximum(counts, 1)
+    return counts/(ring/n_bins), mean_speed
+
+def decimate(y, n_columns: int):
+    """Min, max and mean of y over n_columns contiguous chunks.
+
+    Returns the center index of each chunk and the three statistics,
+    e.g. to draw a curve with one point per pixel column. NaN entries
+    (e.g. the gaps of the empty cells of lwr) are left out, chunks made
+    only of NaN give NaN.
+    """
+    n_columns = max(1, min(n_columns, len(y)))
+    edges = np.linspace(0, len(y), n_columns+1).astype(int)
+    starts = edges[:-1]
+    finite = np.isfinite(y)
+    y_min = np.fmin.reduceat(y, starts)
+    y_max = np.fmax.reduceat(y, starts)
+    with np.errstate(invalid='ignore'):
+        y_mean = np.add.reduceat(np.where(finite, y, 0), starts)/np.add.reduceat(finite, starts)
+    return (edges[:-1]+edges[1:]-1)/2, y_min, y_max, y_mean
+
+def dump_fields(path_to_out: pathlib.Path, real_time: float,
+                distances, speeds, positions):
+    np.save(path_to_out/str('distance_field_'+str(real_time)), distances)
+    np.save(path_to_out/str('speed_field_'+str(real_time)), speeds)
+    np.save(path_to_out/str('positions_'+str(real_time)), positions)
+
+def dump_result_dict(filename: str, result: Dict, verbose: int = 0,
+                     folder: pathlib.Path = None):
     """Dump the result dictionary.
     The function dumps to the file given by complete path
     (relative or absolute) the row composed by results.values(),
@@ -114,10 +285,12 @@ def dump_result_dict(filename: str, result: Dict, verbose: int = 0):
     Args:
         filename ([str]): path to file to dump
         result ([Dict]): dictionary containing the values to dump
+        folder ([pathlib.Path]): folder where to dump, defaults to output/
     """
     # get file path
-    path_to_file = pathlib.Path(__file__).parent.parent.absolute()
-    path_to_file = path_to_file/"output"/(filename+".dat")
+    if folder is None:
+        folder = pathlib.Path(__file__).parent.parent.absolute()/"output"
+    path_to_file = folder/(filename+".dat")
     # touching file
     path_to_file.touch()
     if verbose > 0:
@@ -0,0 +1,142 @@
+from argparse import RawTextHelpFormatter, ArgumentParser
+import pathlib
+import sys
+
+import numpy as np
+import pyqtgraph.opengl as gl
+from pyqtgraph.Qt import QtCore, QtGui
+
+from my_widgets import MyWidget, Window
+from shared_state import StateReader
+from util import compute_positions
+from baselines import V_MAX
+
+log_file = "viewer_log.txt"
+
+class Viewer(object):
+    """Render a simulation running in another process.
+
+    The viewer maps the shared memory published by Simulation.share and
+    draws the latest frame at its own pace; frames overwritten by the
+    simulation while being drawn are simply dropped.
+    """
+    def __init__(self,
+                 name: str = None,
+                 ui_update_ms: int = 30,
+                 path_to_out: pathlib.Path = None):
+        self.reader = StateReader(name)
+        self.path_to_out = path_to_out
+        self.app = QtGui.QApplication([])
+        self.main_window = Window('shared state {}'.format(name))
+        self.w = MyWidget(app=self.app,
+                          visualizer=self,
+                          log_file=self.path_to_out/log_file)
+        self.main_window.setCentralWidget(self.w)
+        self.main_window.show()
+
+        self.ui_update_ms = ui_update_ms
+        self.paused = False
+        self.last_seq = -1
+        self.real_time = 0.0
+        self.cars = []
+        self.traces = dict()
+        self.init_grid()
+        self.draw_cars(is_first=True)
+
+    def start(self):
+        timer = QtCore.QTimer()
+        timer.timeout.connect(self.update)
+        timer.start(self.ui_update_ms)
+        if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
+            code = QtGui.QApplication.instance().exec_()
+            self.reader.close()
+            sys.exit(code)
+
+    def update(self):
+        if not self.paused and self.reader.seq != self.last_seq:
+            self.draw_cars()
+
+    def draw_cars(self, is_first: bool = False):
+        if is_first:
+            self.traces[0] = gl.GLScatterPlotItem(pos=np.zeros((1, 3)), size=7.0)
+            self.w.addItem(self.traces[0])
+        seq, n, self.real_time, radius, x, speed = self.reader.frame()
+        if n == 0:
+            return
+        pts = compute_positions(x, radius)
+        color = np.ones((n, 4))
+        color[:, 1] = np.clip(speed/V_MAX, 0, 1)
+        color[:, 2] = 0
+        if self.reader.valid(seq):
+            self.traces[0].setData(pos=pts, color=color)
+            self.last_seq = seq
+
+    def init_grid(self):
+        self.w.clear()
+        for rotation, translation in [((90, 0, 1, 0), (-25, 0, 0)),
+                                      ((90, 1, 0, 0), (0, -25, 0)),
+                                      (None, (0, 0, -25))]:
+            g = gl.GLGridItem()
+            g.setSize(50.0, 50.0, 50.0)
+            if rotation is not None:
+                g.rotate(*rotation)
+            g.translate(*translation)
+            self.w.addItem(g)
+
+    def init_cars(self):
+        self.last_seq = -1
+
+    # Keys handled by MyWidget: the viewer is read-only, so only pausing
+    # the rendering and dumping the current frame are available.
+    def pause_resume(self):
+        self.paused = not self.paused
+
+    def dump(self):
+        seq, n, real_time, radius, x, speed = self.reader.frame()
+        x, speed = x.copy(), speed.copy()
+        if self.reader.valid(seq):
+            np.save(self.path_to_out/str('speed_field_'+str(real_time)), speed)
+            np.save(self.path_to_out/str('positions_'+str(real_time)), x)
+
+    def set_traffic_light(self):
+        self.log('Traffic light not available in the viewer')
+
+    def external_perturbation(self, id):
+        self.log('Perturbations not available in the viewer')
+
+    def log(self, message: str):
+        with open(self.path_to_out/log_file, 'a') as file:
+            print(message, file=file)
+
+
+if __name__ == '__main__':
+    parser = ArgumentParser(description='Attach to a simulation started with --share '
+                            'and render it in a separate process.',
+                            formatter_class=RawTextHelpFormatter)
+    parser.add_argument('name',
+                        type=type(''),
+                        action='store',
+                        help='Name of the shared memory published by the simulation')
+    parser.add_argument('-t', '--ui_update_ms',
+                        dest='ui_update_ms',
+                        required=False,
+                        type=float,
+                        default=30,
+                        action='store',
+                        help='Set the frame update timestep for the UI (in milliseconds)')
+    parser.add_argument('-o', '--out_folder',
+                        dest='out_folder',
+                        required=False,
+                        type=type(''),
+                        action='store',
+                        help='Set the folder where the outputs will be dumped')
+    args = parser.parse_args()
+    if args.out_folder is None:
+        path_to_out = pathlib.Path(__file__).parent.parent.absolute()/'output'
+    else:
+        path_to_out = pathlib.Path(args.out_folder)
+    path_to_out.mkdir(parents=True, exist_ok=True)
+    v = Viewer(name=args.name,
+               ui_update_ms=int(args.ui_update_ms),
+               path_to_out=path_to_out)
+    v.start()
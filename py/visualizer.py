@@ -0,0 +1,346 @@
+import pathlib
+import sys
+
+import numpy as np
+from math import pi as PI
+import pyqtgraph as pg
+import pyqtgraph.opengl as gl
+from pyqtgraph.Qt import QtCore, QtGui
+from PyQt5.QtWidgets import QHBoxLayout
+
+from util import compute_positions, ring_bins, decimate
+from my_widgets import Slider, MyWidget, Window
+from state import Simulation, log_file
+from space_time import SpaceTimeBuffer
+from baselines import D_CM_MIN, TAU, M_TO_U
+
+class Visualizer(Simulation):
+    def __init__(self,
+                 model: str = None,
+                 ui_update_ms: int = 1,
+                 n_cars: int = None,
+                 radius: float = None,
+                 filling: float = None,
+                 start_speed: float = None,
+                 scheme: str = None,
+                 path_to_out: pathlib.Path = None,
+                 seed: int = 51550,
+                 n_cells: int = 1000,
+                 fd_model: str = 'ftl',
+                 share: str = None,
+                 lod_threshold: int = 20000,
+                 space_time_bins: int = 256,
+                 space_time_rows: int = 500):
+        self.app = QtGui.QApplication([])
+        main_window = Window(model)
+        main_window.show()
+        self.win = pg.GraphicsLayoutWidget(show=True)
+        main_window.setCentralWidget(self.win)
+        self.w = MyWidget(app=self.app,
+                          visualizer=self,
+                          log_file=path_to_out/log_file)
+        self.w.show()
+
+        self.ui_update_ms = ui_update_ms
+        # above this number of cars the views switch to aggregated data
+        # whenever there are more cars than pixels to draw them
+        self.lod_threshold = lod_threshold
+        # size of the space-time diagram: position bins x time steps kept
+        self.space_time_bins = space_time_bins
+        self.space_time_rows = space_time_rows
+        self.time_elapsed = 0
+        self.time_avg_count = 0
+        self.time_avg_limit = 10
+        if model == 'FTL':
+            self.time_avg_limit = 10
+        elif model == 'CA':
+            self.time_avg_limit = 5
+        self.track = None
+        self.speed_field = np.array([0.0]*n_cars)
+        self.dist_field = None
+
+        super(Visualizer, self).__init__(model=model,
+                                         n_cars=n_cars,
+                                         radius=radius,
+                                         filling=filling,
+                                         start_speed=start_speed,
+                                         scheme=scheme,
+                                         path_to_out=path_to_out,
+                                         seed=seed,
+                                         n_cells=n_cells,
+                                         fd_model=fd_model)
+        if share is not None:
+            self.share(share)
+
+        self.init_grid()
+        self.traces = dict()
+        self.draw_cars(is_first=True)
+
+        self.compute_speed_and_density()
+
+        # get a layout
+        self.layoutgb = QtGui.QGridLayout()
+        self.win.setLayout(self.layoutgb)
+        self.layoutgb.addWidget(self.w, 0, 0)
+        self.w.sizeHint = lambda: pg.QtCore.QSize(50, 50)
+        
+        self.init_controls()
+
+        self.init_plots()
+
+        self.animation()
+
+    def start(self):
+        if (sys.flags.interactive != 1) or not hasattr(QtCore, 'PYQT_VERSION'):
+            sys.exit(QtGui.QApplication.instance().exec_())
+            
+    def draw_cars(self, is_first: bool = False):
+        if is_first:
+            self.traces['cars'] = gl.GLScatterPlotItem(pos=np.zeros((1, 3)), size=7.0)
+            self.traces['band'] = gl.GLLinePlotItem(pos=np.zeros((1, 3)), width=6.0,
+                                                    mode='line_strip', antialias=True)
+            self.w.addItem(self.traces['cars'])
+            self.w.addItem(self.traces['band'])
+        if self.model == 'lwr':
+            # the macroscopic model has no cars, only the band
+            self.set_band_data(self.positions(), self.engine.density, self.speeds())
+            return
+        x, speed = self.positions(), self.speeds()
+        ring_pixels = self.ring_pixels()
+        if self.n > self.lod_threshold and self.n > ring_pixels:
+            self.draw_band(x, speed, n_bins=max(int(ring_pixels), 1))
+        else:
+            color = np.ones((len(x), 4))
+            color[:, 1] = np.clip(speed/self.v_max, 0, 1)
+            color[:, 2] = 0
+            self.set_points_data('cars', compute_positions(x, self.radius), color)
+            self.traces['band'].setData(pos=np.zeros((0, 3)))
+
+    def draw_band(self, x, speed, n_bins):
+        """Draw the ring as a band coloured by the binned mean speed.
+
+        The opacity of each bin grows with its density, a full jam (one
+        car every D_CM_MIN) being opaque.
+        """
+        density, mean_speed = ring_bins(x, speed, self.ring, n_bins)
+        centers = (np.arange(n_bins) + 0.5)*self.ring/n_bins
+        self.set_band_data(centers, density, mean_speed)
+
+    def set_band_data(self, centers, density, mean_speed):
+        # the first vertex is repeated to close the ring
+        idx = np.arange(len(centers)+1) % len(centers)
+        color = np.ones((len(idx), 4))
+        color[:, 1] = np.clip(mean_speed/self.v_max, 0, 1)[idx]
+        color[:, 2] = 0
+        color[:, 3] = np.clip(density, 0.1, 1)[idx]
+        self.traces['band'].setData(pos=compute_positions(centers[idx], self.radius), color=color)
+        self.traces['cars'].setData(pos=np.zeros((0, 3)))
+
+    def ring_pixels(self):
+        """Estimated length of the ring on screen, in pixels."""
+        half_width = self.w.opts['distance']*np.tan(np.radians(self.w.opts['fov'])/2)
+        pixels_per_unit = max(self.w.width(), 1)/(2*half_width)
+        return 2*PI*self.radius*M_TO_U*pixels_per_unit
+
+    def set_points_data(self, name, points, color):
+        self.traces[name].setData(pos=points, color=color)
+
+    def set_plots_data(self):
+        if self.time_avg_count == self.time_avg_limit:
+            self.speed_field = np.nan_to_num(self.speed_field, posinf=self.v_max, neginf=0.0)
+            self.plotted_fields = {'speed': self.speed_field, 'density': self.dist_field}
+            self.refresh_plots()
+
+    def refresh_plots(self):
+        for name, y in self.plotted_fields.items():
+            self.set_curve_data(self.curves[name], y)
+
+    def set_curve_data(self, curves, y):
+        """Plot y against the car (or lwr cell) index, one point per pixel column at most.
+
+        When more than lod_threshold cars are in view, the curves show the
+        mean, min and max of each pixel column; zooming in on fewer cars
+        brings back one sample per car.
+        """
+        widget, mean_curve, min_curve, max_curve = curves
+        x0, x1 = widget.getViewBox().viewRange()[0]
+        i0, i1 = max(int(np.floor(x0)), 0), min(int(np.ceil(x1))+1, len(y))
+        if i1 <= i0:
+            i0, i1 = 0, len(y)
+        n_columns = max(int(widget.getViewBox().width()), 1)
+        if i1 - i0 > self.lod_threshold and i1 - i0 > n_columns:
+            x, y_min, y_max, y_mean = decimate(y[i0:i1], n_columns)
+            x = x + i0
+            mean_curve.setData(x, y_mean)
+            min_curve.setData(x, y_min)
+            max_curve.setData(x, y_max)
+        else:
+            mean_curve.setData(np.arange(i0, i1), y[i0:i1])
+            min_curve.setData([], [])
+            max_curve.setData([], [])
+
+    def set_space_time_data(self):
+        """Write the current speeds into the next row of the space-time diagram.
+
+        Only the new row of the buffer is written; the image keeps the
+        same size and the white line marks the latest row.
+        """
+        self.space_time.push(self.positions(),
+                             self.speeds()*3.6*D_CM_MIN/TAU,
+                             self.ring)
+        self.space_time_image.updateImage()
+        self.space_time_cursor.setValue(self.space_time.row)
+
+    def compute_speed_and_density(self):
+        self.time_avg_count+=1
+        if self.time_avg_count > self.time_avg_limit:
+            self.time_avg_count = 0
+        if self.time_avg_count == 1:
+            self.speed_field = np.zeros(len(self.positions()))
+            self.dist_field = np.zeros(len(self.positions()))
+        self.speed_field = self.speed_field + self.speeds()*3.6*D_CM_MIN/self.time_avg_limit/TAU
+        self.dist_field = self.dist_field + self.distances()*D_CM_MIN/self.time_avg_limit
+
+    def update(self):
+        if self.delta_t > 0:
+            self.step()
+            self.draw_cars()
+            self.compute_speed_and_density()
+            self.set_plots_data()
+            self.set_space_time_data()
+
+    def animation(self):
+        timer = QtCore.QTimer()
+        timer.timeout.connect(self.update)
+        timer.start(self.ui_update_ms)
+        self.start()
+
+    def set_n_cars(self, n_cars):
+        self.pause_resume()
+        self.n = int(n_cars)
+        self.thetas = np.linspace(0.0, 2*PI*self.filling, self.n, endpoint=False)
+        with open(self.path_to_out/log_file, 'a') as file:
+            print('Setting number of cars to {}'.format(self.n), file=file)
+            print('\tCurrent density is {} m^-1'.format(self.n/self.ring/D_CM_MIN), file=file)
+            print('\tSpace per car {} m\n'.format(self.ring*D_CM_MIN/self.n), file=file)
+        self.pause_resume()
+        self.init_cars()
+        self.init_grid()
+        self.traces = dict()
+        self.draw_cars(True)
+        self.init_plots()
+        
+    def set_radius(self, new_radius):
+        self.pause_resume()
+        self.radius = new_radius*1000/D_CM_MIN # radius is given in km
+        self.ring = 2*PI*self.radius
+        with open(self.path_to_out/log_file, 'a') as file:
+            print('Setting radius of the ring to {} m'.format(self.radius*D_CM_MIN), file=file)
+            print('\tCurrent density is {} m^-1'.format(self.n/self.ring/D_CM_MIN), file=file)
+            print('\tRing length {} m'.format(self.ring*D_CM_MIN), file=file)
+            print('\tSpace per car {} m\n'.format(self.ring*D_CM_MIN/self.n), file=file)
+        self.pause_resume()
+        self.init_cars()
+        self.draw_cars()
+        self.init_plots()
+    
+    def set_filling(self, filling):
+        self.pause_resume()
+        self.filling = filling/100
+        self.thetas = np.linspace(0.0, 2*PI*self.filling, self.n, endpoint=False)
+        with open(self.path_to_out/log_file, 'a') as file:
+            print('Setting initial filling to {}'.format(self.filling), file=file)
+        self.pause_resume()
+        self.init_cars()
+        self.init_grid()
+        self.draw_cars(True)
+        self.init_plots()
+    
+    def init_plots(self):
+        self.speed_plot = pg.PlotWidget()
+        self.density_plot = pg.PlotWidget()
+        
+        # the fields of lwr have one value per cell
+        index = 'cell' if self.model == 'lwr' else 'car'
+        self.speed_plot.setLabels(title='Cars\' speeds', left='v [km/h]', bottom=index)
+        #self.density_plot.setLabels(title='Line density', left='rho [1/m]', bottom='position [m]')
+        self.density_plot.setLabels(title='Density as distances between cars', left='d [m]', bottom=index)
+        
+        self.density_plot.setYRange(0, 2*self.ring*D_CM_MIN/self.n)
+        self.speed_plot.setYRange(0, self.v_max*3.6*D_CM_MIN/TAU+10)
+        
+        self.layoutgb.addWidget(self.speed_plot, 1, 1)
+        self.layoutgb.addWidget(self.density_plot, 1, 0)
+        
+        self.speed_plot.sizeHint = lambda: pg.QtCore.QSize(50, 50)
+        self.density_plot.sizeHint = lambda: pg.QtCore.QSize(50, 50)
+        
+        self.init_space_time()
+        
+        self.w.setSizePolicy(self.speed_plot.sizePolicy())
+        
+        self.curves = dict()
+        for name, widget, pen in [('speed', self.speed_plot, 'y'),
+                                  ('density', self.density_plot, 'r')]:
+            widget.setXRange(0, len(self.positions()))
+            envelope = pg.mkColor(pen)
+            envelope.setAlpha(100)
+            # the gaps of the empty cells of lwr are NaN and left blank
+            self.curves[name] = (widget,
+                                 widget.plot(pen=pen, connect='finite'),
+                                 widget.plot(pen=envelope, connect='finite'),
+                                 widget.plot(pen=envelope, connect='finite'))
+            widget.sigXRangeChanged.connect(lambda *args: self.refresh_plots())
+        self.speed_plot = self.curves['speed'][1]
+        self.density_plot = self.curves['density'][1]
+        self.plotted_fields = dict()
+        self.time_avg_count = 0
+        self.set_plots_data()
+    
+    def init_space_time(self):
+        self.space_time_plot = pg.PlotWidget()
+        self.space_time_plot.setLabels(title='Space-time diagram of the speeds',
+                                       left='position [m]', bottom='step (circular)')
+        self.space_time = SpaceTimeBuffer(n_bins=self.space_time_bins,
+                                          n_rows=self.space_time_rows)
+        # same colours as the cars: red when still, yellow at max speed
+        cmap = pg.ColorMap([0.0, 1.0], [(255, 0, 0), (255, 255, 0)])
+        self.space_time_image = pg.ImageItem(self.space_time.image,
+                                             levels=(0, self.v_max*3.6*D_CM_MIN/TAU))
+        self.space_time_image.setLookupTable(cmap.getLookupTable())
+        self.space_time_image.setRect(QtCore.QRectF(0, 0, self.space_time_rows,
+                                                    self.ring*D_CM_MIN))
+        self.space_time_cursor = pg.InfiniteLine(pos=0, angle=90, pen='w')
+        self.space_time_plot.addItem(self.space_time_image)
+        self.space_time_plot.addItem(self.space_time_cursor)
+        self.layoutgb.addWidget(self.space_time_plot, 1, 2)
+        self.space_time_plot.sizeHint = lambda: pg.QtCore.QSize(50, 50)
+
+    def init_controls(self):
+        h_layout = QHBoxLayout()
+        self.w1 = Slider(1, 200, name='Cars', initial_value=self.n, visualizer_fn=self.set_n_cars)
+        self.w2 = Slider(0, 2.5, name='Radius (km)', initial_value=self.radius/1000*D_CM_MIN, visualizer_fn=self.set_radius, dtype=float)
+        self.w3 = Slider(0, 100, name='Ring\ninitial\nfilling', initial_value=self.filling*100, visualizer_fn=self.set_filling)
+        h_layout.addWidget(self.w1)
+        h_layout.addWidget(self.w2)
+        h_layout.addWidget(self.w3)
+        self.layoutgb.addLayout(h_layout, 0, 1)
+        
+    def init_grid(self):
+        self.w.clear()
+        # create the background grids
+        gx = gl.GLGridItem()
+        gx.setSize(50.0, 50.0, 50.0)
+        gx.rotate(90, 0, 1, 0)
+        gx.translate(-25, 0, 0)
+        self.w.addItem(gx)
+        gy = gl.GLGridItem()
+        gy.setSize(50.0, 50.0, 50.0)
+        gy.rotate(90, 1, 0, 0)
+        gy.translate(0, -25, 0)
+        self.w.addItem(gy)
+        gz = gl.GLGridItem()
+        gz.setSize(50.0, 50.0, 50.0)
+        gz.translate(0, 0, -25)
+        self.w.addItem(gz)
+